@@ -0,0 +1,95 @@
+import cv2
+import numpy as np
+
+def frame_signature(frame, hash_size=8):
+    """
+    Compute a cheap difference hash of a frame.
+
+    :param frame: RGB numpy array.
+    :param hash_size: Width and height of the downscaled grid, the hash has hash_size ** 2 bits.
+    :return: Packed bits as a uint8 numpy array.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+def signature_distance(a, b):
+    """
+    Number of differing bits between two frame signatures.
+    """
+    return int(np.unpackbits(np.bitwise_xor(a, b)).sum())
+
+class AdaptiveSampler:
+    """
+    Decide which sampled frames actually need to go through the model.
+
+    A frame whose signature is within `threshold` bits of the last inferred frame reuses that
+    frame's prediction. After a scene change the next `burst` frames are always inferred, so
+    transitions are sampled densely while static stretches are mostly skipped. A prediction is
+    never reused for more than `max_reuse` frames in a row.
+    """
+
+    def __init__(self, threshold=5, burst=3, max_reuse=30, hash_size=8):
+        self.threshold = threshold
+        self.burst = burst
+        self.max_reuse = max_reuse
+        self.hash_size = hash_size
+
+        # Maps each skipped frame index to the index of the frame whose prediction it reuses
+        self.reused = {}
+        self.frames_inferred = 0
+        self.scene_changes = 0
+
+        self._reference_index = None
+        self._reference_signature = None
+        self._burst_left = 0
+        self._reuse_run = 0
+
+    def check(self, frame_index, frame):
+        """
+        Look at the next sampled frame.
+
+        :return: None if the frame must be inferred, otherwise the index of the frame whose
+                 prediction should be reused.
+        """
+        signature = frame_signature(frame, self.hash_size)
+
+        if self._reference_signature is not None:
+            distance = signature_distance(signature, self._reference_signature)
+            if distance > self.threshold:
+                self.scene_changes += 1
+                self._burst_left = self.burst
+            elif self._burst_left == 0 and self._reuse_run < self.max_reuse:
+                self._reuse_run += 1
+                self.reused[frame_index] = self._reference_index
+                return self._reference_index
+            else:
+                self._burst_left = max(self._burst_left - 1, 0)
+
+        self._reference_index = frame_index
+        self._reference_signature = signature
+        self._reuse_run = 0
+        self.frames_inferred += 1
+        return None
+
+    def filter(self, frames):
+        """
+        Wrap a frame generator such as iter_frames, yielding only the frames to infer.
+        """
+        for frame_index, timestamp, frame in frames:
+            if self.check(frame_index, frame) is None:
+                yield frame_index, timestamp, frame
+
+    @property
+    def skip_ratio(self):
+        total = self.frames_inferred + len(self.reused)
+        return len(self.reused) / total if total else 0.0
+
+    def stats(self):
+        return {
+            'similarity_threshold': self.threshold,
+            'frames_inferred': self.frames_inferred,
+            'frames_reused': len(self.reused),
+            'scene_changes': self.scene_changes,
+            'skip_ratio': self.skip_ratio,
+        }
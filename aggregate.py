@@ -1,40 +1,91 @@
-import os
-from collections import Counter
+import numpy as np
 from utils import index_to_class
+
 def frames_to_time(frame_index, fps):
     return round(frame_index / fps, 2)
 
+def run_lengths(frame_indices, labels):
+    """
+    Compute segments, label counts and the first frame of every label in one vectorized pass.
+
+    A segment runs from its first frame up to the frame before the next segment starts, the last
+    one up to the last frame.
+
+    :param frame_indices: Sorted numpy array with the source frame index of every prediction.
+    :param labels: Numpy array of the same length with the predicted label indices.
+    :return: Dictionary of numpy arrays: 'labels', 'start_frames' and 'end_frames' describe the
+             segments, 'label_values', 'counts' and 'first_frames' give for every distinct label
+             its number of frames and its first frame index.
+    """
+    frame_indices = np.asarray(frame_indices)
+    labels = np.asarray(labels)
+    if labels.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return {'labels': labels[:0], 'start_frames': empty, 'end_frames': empty,
+                'label_values': labels[:0], 'counts': empty, 'first_frames': empty}
+
+    changes = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.concatenate(([0], changes))
+    end_frames = np.concatenate((frame_indices[changes] - 1, frame_indices[-1:]))
+
+    label_values, first_positions, counts = np.unique(labels, return_index=True, return_counts=True)
+    return {
+        'labels': labels[starts],
+        'start_frames': frame_indices[starts],
+        'end_frames': end_frames,
+        'label_values': label_values,
+        'counts': counts,
+        'first_frames': frame_indices[first_positions],
+    }
+
+def summarize_labels(frame_indices, labels, fps, names=index_to_class):
+    """
+    Turn a label-index array into the segments, label counts and first frames shown to the user.
+
+    Label indices are only mapped to their names here, at render time.
+
+    :param names: Mapping of label index to label name, unknown indices become 'Unknown'.
+    :return: Tuple (segments, label_occurrences, first_frames) where segments is a list of
+             dictionaries as returned by group_consecutive_frames, label_occurrences maps label
+             names to frame counts and first_frames maps label names to their first frame index.
+    """
+    runs = run_lengths(frame_indices, labels)
+    segment_names = [names.get(int(label), 'Unknown') for label in runs['labels']]
+    segments = [{'label': name,
+                 'start_time': int(start) / fps,
+                 'end_time': int(end) / fps,
+                 'start_frame': int(start),
+                 'end_frame': int(end)}
+                for name, start, end in zip(segment_names, runs['start_frames'], runs['end_frames'])]
+
+    label_occurrences = {}
+    first_frames = {}
+    for label, count, first_frame in zip(runs['label_values'], runs['counts'], runs['first_frames']):
+        name = names.get(int(label), 'Unknown')
+        label_occurrences[name] = label_occurrences.get(name, 0) + int(count)
+        first_frames[name] = min(first_frames.get(name, int(first_frame)), int(first_frame))
+    return segments, label_occurrences, first_frames
+
+def encode_predictions(predictions):
+    """
+    Convert a {frame index: label name} dictionary to sorted arrays plus the label vocabulary.
+
+    :return: Tuple (frame_indices, labels, names) usable with summarize_labels.
+    """
+    frame_indices = np.fromiter(sorted(predictions), dtype=np.int64, count=len(predictions))
+    vocabulary = {name: index for index, name in enumerate(sorted(set(predictions.values())))}
+    labels = np.fromiter((vocabulary[predictions[frame_index]] for frame_index in frame_indices.tolist()),
+                         dtype=np.int32, count=len(predictions))
+    return frame_indices, labels, {index: name for name, index in vocabulary.items()}
+
+def group_predictions(predictions, fps):
+    """
+    Group consecutive frames of a {frame index: label name} dictionary into segments.
+    """
+    frame_indices, labels, names = encode_predictions(predictions)
+    segments, _, _ = summarize_labels(frame_indices, labels, fps, names)
+    return segments
+
 def aggregate_predictions_with_samples(predictions, fps, interval=10):
-    def frames_to_time(frame_index, fps):
-        return frame_index / fps
-
-    aggregated = []
-    current_label = None
-    start_frame = None
-
-    sorted_frames = sorted(predictions.keys())
-    
-    for frame_index in sorted_frames:
-        label = predictions.get(frame_index, 'Unknown')
-
-        # If we're starting a new label sequence
-        if current_label is None:
-            current_label = label
-            start_frame = frame_index
-        elif label != current_label:
-            # If the label changes, save the previous range
-            start_time = frames_to_time(start_frame, fps)
-            end_time = frames_to_time(frame_index - 1, fps)  # The last frame of the previous label
-            aggregated.append(f"{start_time:.2f}-{end_time:.2f}s: {current_label}")
-
-            # Start the new label sequence
-            current_label = label
-            start_frame = frame_index
-
-    # Capture the last label sequence
-    if current_label is not None:
-        start_time = frames_to_time(start_frame, fps)
-        end_time = frames_to_time(sorted_frames[-1], fps)  # The last frame in the video
-        aggregated.append(f"{start_time:.2f}-{end_time:.2f}s: {current_label}")
-
-    return aggregated
+    return [f"{segment['start_time']:.2f}-{segment['end_time']:.2f}s: {segment['label']}"
+            for segment in group_predictions(predictions, fps)]
@@ -1,107 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, stream_with_context
 import os
-from utils import extract_frames, predict_frame, group_consecutive_frames, count_label_occurrences
-from model import load_combined_model
-from torchvision import transforms
-import cv2
-from collections import defaultdict
-from celery import Celery
+import time
+import hashlib
+import shutil
+import json
+import tempfile
+import uuid
+from celery_app import (celery, PROCESS_VIDEO_TASK, PROGRESS_INTERVAL, UPLOAD_FOLDER, UPLOAD_SESSIONS_FOLDER,
+                        FRAMES_FOLDER, FRAME_RATE, SAMPLING_MODE, ADAPTIVE_THRESHOLD, result_cache, results_config,
+                        current_weights_digest)
+from utils import SAMPLING_MODES
+from result_cache import cache_key
+from descriptions import description_index
+from workspaces import create_workspace, cleanup_workspaces, workspace_path
+from metrics import registry, render_prometheus
+import uploads
+
+# Web tier: serves uploads, progress and results and hands videos to the workers in tasks.py by
+# task name, so it never imports torch, OpenCV or the model
 
 app = Flask(__name__, template_folder='templates')  # Adjust path if needed
-app.config['CELERY_BROKER_URL'] = 'redis://localhost:6379/0'  # Update this if using a cloud service
-app.config['CELERY_RESULT_BACKEND'] = 'redis://localhost:6379/0'  # Update this if using a cloud service
-celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-celery.conf.update(app.config)
-
-# Path for uploaded videos and extracted frames
-UPLOAD_FOLDER = 'uploads/'
-FRAMES_FOLDER = 'static/frames/'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Ensure directories exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(FRAMES_FOLDER, exist_ok=True)
-
-# Define the transformation for images
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),  # Adjust size if necessary
-    transforms.ToTensor(),
-])
-
-# Load the model
-model = None
-def get_model():
-    global model
-    if model is None:
-        print("Loading the model...")
-        model = load_combined_model(num_classes=23)  # Lazy load the model
-        model.eval()  # Set the model to evaluation mode
-    return model
-@celery.task
-def process_video(video_path):
-    # Extract frames from the video
-    extract_frames(video_path, FRAMES_FOLDER)
-
-    # Perform frame analysis
-    predictions = {}
-    fps = extract_fps(video_path)
-    if fps is None:
-        return "Error: Could not extract FPS from the video", 500
-    model = get_model()
-
-    # To store the first frame for each label
-    example_images = {}
-
-    # Perform prediction on each frame
-    for frame_file in sorted(os.listdir(FRAMES_FOLDER)):
-        if frame_file.endswith('.jpg'):
-            frame_path = os.path.join(FRAMES_FOLDER, frame_file)
-            frame_index = int(os.path.splitext(frame_file)[0].split('_')[-1])
-            try:
-                predicted_label = predict_frame(model, frame_path, transform)
-                predictions[frame_index] = predicted_label
-
-                # Save an example image for each label
-                if predicted_label not in example_images:
-                    example_images[predicted_label] = frame_path
-            except Exception as e:
-                print(f"Error processing {frame_file}: {e}")
-
-    # Group consecutive frames with the same predicted label
-    aggregated_results = group_consecutive_frames(predictions, fps)
-
-    # Count label occurrences
-    label_occurrences = count_label_occurrences(predictions)
-    class_description = {
-    "lower-gi-tract/anatomical-landmarks/cecum": "The cecum is the beginning of the large intestine and is a critical anatomical landmark in the lower gastrointestinal tract. It plays a role in absorbing fluids and salts that remain after intestinal digestion and absorption.",
-    "lower-gi-tract/anatomical-landmarks/ileum": "The ileum is the final section of the small intestine, where absorption of vitamin B12 and bile salts occurs. It is a key anatomical landmark in the lower gastrointestinal tract.",
-    "lower-gi-tract/anatomical-landmarks/retroflex-rectum": "Retroflex view of the rectum is an endoscopic technique used to inspect the rectum more thoroughly, especially for polyps or other abnormalities.",
-    "lower-gi-tract/pathological-findings/hemorrhoids": "Hemorrhoids are swollen veins in the lower rectum or anus, often causing discomfort, itching, or bleeding. They are a common pathological finding in the lower gastrointestinal tract.",
-    "lower-gi-tract/pathological-findings/polyps": "Polyps are abnormal growths of tissue that form on the lining of the colon or rectum. They can vary in size and have the potential to develop into colorectal cancer if left untreated.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-0-1": "Ulcerative Colitis Grade 0-1 indicates minimal to mild inflammation of the colon, characterized by superficial ulcerations and erythema. It is an early stage of the disease in the lower gastrointestinal tract.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1": "Ulcerative Colitis Grade 1 is marked by mild inflammation in the colon with superficial ulcerations and erythema. It is an early stage of ulcerative colitis.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1-2": "Ulcerative Colitis Grade 1-2 represents moderate inflammation of the colon, with more pronounced ulcerations and erythema. This stage indicates a progression of the disease.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2": "Ulcerative Colitis Grade 2 involves moderate inflammation and ulceration in the colon. It is a more advanced stage of the disease, requiring careful monitoring.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2-3": "Ulcerative Colitis Grade 2-3 indicates severe inflammation with extensive ulceration and erythema. This stage of the disease requires aggressive treatment.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-3": "Ulcerative Colitis Grade 3 is characterized by severe inflammation, deep ulcerations, and extensive tissue damage in the colon. It is the most advanced stage of the disease.",
-    "lower-gi-tract/quality-of-mucosal-views/bbps-0-1": "The Boston Bowel Preparation Scale (BBPS) score of 0-1 indicates poor bowel preparation, with a significant amount of stool obstructing the view during a colonoscopy, affecting the quality of mucosal views.",
-    "lower-gi-tract/quality-of-mucosal-views/bbps-2-3": "The Boston Bowel Preparation Scale (BBPS) score of 2-3 indicates fair to good bowel preparation, with partial to clear views of the mucosa during a colonoscopy, allowing for a more thorough examination.",
-    "lower-gi-tract/quality-of-mucosal-views/impacted-stool": "Impacted stool refers to a large, hard mass of stool that is stuck in the colon or rectum. It can obscure the view during endoscopic procedures, compromising the quality of mucosal views.",
-    "lower-gi-tract/therapeutic-interventions/dyed-lifted-polyps": "Dyed lifted polyps refer to polyps that have been injected with a dye solution to lift them away from the mucosal layer during an endoscopic procedure, facilitating their removal.",
-    "lower-gi-tract/therapeutic-interventions/dyed-resection-margins": "Dyed resection margins refer to the edges of tissue that have been stained with dye during an endoscopic procedure to ensure that the entire lesion or polyp has been removed.",
-    "upper-gi-tract/anatomical-landmarks/pylorus": "The pylorus is the opening from the stomach into the duodenum (first part of the small intestine). It is an important anatomical landmark in the upper gastrointestinal tract, controlling the passage of stomach contents.",
-    "upper-gi-tract/anatomical-landmarks/retroflex-stomach": "Retroflex view of the stomach is an endoscopic technique used to inspect the upper part of the stomach, especially for detecting abnormalities such as polyps, ulcers, or tumors.",
-    "upper-gi-tract/anatomical-landmarks/z-line": "The Z-line, or squamocolumnar junction, is where the esophagus meets the stomach. It is an important anatomical landmark in the upper gastrointestinal tract, often inspected for signs of Barrett's esophagus or other conditions.",
-    "upper-gi-tract/pathological-findings/barretts": "Barrett's esophagus is a condition in which the lining of the esophagus changes to resemble the lining of the stomach, increasing the risk of esophageal cancer. It is a significant pathological finding in the upper gastrointestinal tract.",
-    "upper-gi-tract/pathological-findings/barretts-short-segment": "Barrett's esophagus with a short segment refers to a limited area of the esophagus where the lining has changed to resemble the stomach lining. This condition increases the risk of developing esophageal cancer.",
-    "upper-gi-tract/pathological-findings/esophagitis-a": "Esophagitis Grade A indicates mild inflammation of the esophagus, often due to acid reflux. It is characterized by small, isolated areas of erosion in the lining of the esophagus.",
-    "upper-gi-tract/pathological-findings/esophagitis-b-d": "Esophagitis Grades B-D represent progressively severe inflammation and damage to the esophagus lining, often due to acid reflux, with Grade D being the most severe, involving extensive erosion."
-}
-
-    # Update image paths for rendering
-    images_with_labels = {label: os.path.basename(path) for label, path in example_images.items()}
-    return aggregated_results, label_occurrences, images_with_labels
-    
+# Longest a progress stream stays open before the client has to reconnect
+STREAM_MAX_SECONDS = float(os.environ.get('STREAM_MAX_SECONDS', 300))
+# Requests larger than the largest accepted video are refused before anything is written
+app.config['MAX_CONTENT_LENGTH'] = uploads.MAX_UPLOAD_BYTES
+
 @app.route('/test')
 def test():
     return render_template('test.html')  # Ensure test.html is in the templates folder
@@ -117,35 +42,314 @@ def index():
             return redirect(request.url)
         
         if file:
-            video_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-            file.save(video_path)
-             
-            
-            task = process_video.delay(video_path)
-            return redirect(url_for('task_status', task_id=task.id))  # Redirect to a status page
-
-    return render_template('index.html')
+            video_path, video_sha256 = save_upload(file, app.config['UPLOAD_FOLDER'])
+            registry.inc('uploads_total')
+            options = parse_sampling_options(request.form)
+
+            # The same recording uploaded again with the same settings is served from the cache
+            results = cached_results(video_sha256, options)
+            if results is not None:
+                return render_results(results)
+
+            task_id = submit_video(video_path, video_sha256, options)
+            return redirect(url_for('task_status', task_id=task_id))  # Redirect to a status page
+
+    return render_template('index.html', max_chunk_bytes=uploads.MAX_CHUNK_BYTES)
+
+def cached_results(video_sha256, options):
+    """
+    :return: The cached results of a video processed with the given sampling options, or None.
+    """
+    if current_weights_digest() is None:
+        return None
+    job_id = uuid.uuid4().hex
+    cleanup_workspaces(FRAMES_FOLDER, keep=(job_id,))
+    workspace = create_workspace(FRAMES_FOLDER, job_id)
+    results = result_cache.get(cache_key(video_sha256, results_config(*options)),
+                               workspace, image_prefix=f"{job_id}/", data_folder=workspace)
+    if results is None:
+        shutil.rmtree(workspace, ignore_errors=True)
+        return None
+    results[3].update(result_cache='hit', job_id=job_id)
+    registry.inc('result_cache_hits_total')
+    return results
+
+def submit_video(video_path, video_sha256, options, upload_id=None):
+    """
+    Hand a video to the workers.
+
+    :param upload_id: Chunked upload the worker follows while it is still arriving, video_path
+                      and video_sha256 are None then.
+    :return: Id of the process_video task.
+    """
+    task = celery.send_task(PROCESS_VIDEO_TASK, args=(video_path, *options),
+                            kwargs={'video_sha256': video_sha256, 'enqueued_at': time.time(),
+                                    'upload_id': upload_id})
+    return task.id
+
+def _start_processing(video_path, video_sha256, options):
+    # URL to follow the processing of a complete upload at
+    # Only checked here, /videos/<sha> copies the cached images out when the client gets there
+    key = cache_key(video_sha256, results_config(*options))
+    if current_weights_digest() is not None and result_cache.contains(key):
+        frame_rate, sampling_mode, similarity_threshold = options
+        return url_for('video_results', video_sha256=video_sha256, frame_rate=frame_rate,
+                       sampling_mode=sampling_mode, similarity_threshold=similarity_threshold)
+    return url_for('task_status', task_id=submit_video(video_path, video_sha256, options))
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """
+    Open a chunked upload.
+
+    JSON body: filename, size (bytes), optional sha256 of the content, and the sampling options of
+    the upload form. A video whose sha256 was uploaded before is not transferred again.
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        size = int(body.get('size'))
+    except (TypeError, ValueError):
+        return jsonify(error="size must be the file size in bytes"), 400
+    if size <= 0:
+        return jsonify(error="size must be the file size in bytes"), 400
+    if size > uploads.MAX_UPLOAD_BYTES:
+        return jsonify(error=f"Videos are limited to {uploads.MAX_UPLOAD_BYTES} bytes"), 413
+    options = parse_sampling_options(body)
+    sha256 = (body.get('sha256') or '').lower() or None
+
+    stored_path = uploads.find_upload(app.config['UPLOAD_FOLDER'], sha256)
+    if stored_path is not None:
+        registry.inc('uploads_total')
+        registry.inc('uploads_deduplicated_total')
+        return jsonify(complete=True, url=_start_processing(stored_path, sha256, options))
+
+    uploads.cleanup_sessions(UPLOAD_SESSIONS_FOLDER)
+    session = uploads.create_session(UPLOAD_SESSIONS_FOLDER, body.get('filename') or '', size, options, sha256)
+    return jsonify(upload_id=session['upload_id'], offset=0, chunk_size=uploads.MAX_CHUNK_BYTES,
+                   url=url_for('upload_chunk', upload_id=session['upload_id'])), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk(upload_id):
+    """
+    GET returns the number of bytes received so far, to resume from. PUT appends the request body,
+    which must start at the byte given by the offset query parameter.
+
+    Progressive containers are handed to the workers as soon as EARLY_START_BYTES arrived, the
+    others once every byte arrived. Both answer with the URL to follow the processing at, once it
+    started. The worker checks the digest of the upload and moves it into the upload folder.
+    """
+    try:
+        session = uploads.load_session(UPLOAD_SESSIONS_FOLDER, upload_id)
+    except (ValueError, FileNotFoundError):
+        return jsonify(error=f"No upload '{upload_id}'"), 404
+    received = session['received']
+
+    if request.method == 'PUT' and not session['uploaded']:
+        if request.content_length is not None and request.content_length > uploads.MAX_CHUNK_BYTES:
+            return jsonify(error=f"Chunks are limited to {uploads.MAX_CHUNK_BYTES} bytes"), 413
+        try:
+            offset = int(request.args.get('offset', ''))
+            received = uploads.append_chunk(UPLOAD_SESSIONS_FOLDER, session, offset, request.stream)
+        except ValueError as e:
+            # Out of order, repeated or oversized chunk: the client resumes from the offset returned
+            received = uploads.load_session(UPLOAD_SESSIONS_FOLDER, upload_id)['received']
+            return jsonify(error=str(e), offset=received), 409
+
+        options = tuple(session['options'])
+        # Checking for a task and queueing one is a single step, concurrent chunks queue it once
+        with uploads.edit_session(UPLOAD_SESSIONS_FOLDER, upload_id) as session:
+            if received == session['size']:
+                # The worker checks and stores the file, hashing a large video would outlive the request
+                if not session['uploaded']:
+                    registry.inc('uploads_total')
+                session['uploaded'] = True
+                if session['task_id'] is None:
+                    session['task_id'] = submit_video(None, None, options, upload_id=upload_id)
+            elif (session['task_id'] is None and 0 <= uploads.EARLY_START_BYTES <= received
+                    and options[1] != 'keyframe' and uploads.is_progressive(UPLOAD_SESSIONS_FOLDER, session, received)):
+                # Start on the part received so far, the worker follows the rest as it arrives
+                session['task_id'] = submit_video(None, None, options, upload_id=upload_id)
+                registry.inc('uploads_started_early_total')
+
+    url = url_for('task_status', task_id=session['task_id']) if session['task_id'] is not None else None
+    return jsonify(offset=received, size=session['size'], complete=session['uploaded'], url=url)
+
+@app.route('/videos/<video_sha256>')
+def video_results(video_sha256):
+    """
+    Cached results of a stored video, for the sampling options given as query parameters.
+    """
+    results = cached_results(video_sha256, parse_sampling_options(request.args))
+    if results is None:
+        return "No results for this video", 404
+    return render_results(results)
+
+@app.after_request
+def flush_metrics(response):
+    # Make what this web process counted visible to the /metrics route of the others
+    registry.flush()
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/task-status/<task_id>')
 def task_status(task_id):
-    task = process_video.AsyncResult(task_id)
-    if task.state == 'PENDING':
+    task = celery.AsyncResult(task_id)
+    if task.state in ('PENDING', 'STARTED', 'PROGRESS'):
         # Task is still processing
-        return "Task is processing..."
-    elif task.state != 'FAILURE':
+        progress = dict(task.info) if task.state == 'PROGRESS' else {}
+        if request.args.get('format') == 'json':
+            return jsonify(state=task.state, **progress)
+        return render_template('status.html', task_id=task_id, progress=progress)
+    elif task.state == 'SUCCESS':
         # Task completed successfully
-        results = task.result
-        return render_template('results.html', predictions=results[0], 
-                               label_occurrences=results[1], 
-                               example_images=results[2])
+        return render_results(task.result)
     else:
         return "Task failed!"
-def extract_fps(video_path):
-    video = cv2.VideoCapture(video_path)
-    if not video.isOpened():
-        return None
-    fps = video.get(cv2.CAP_PROP_FPS)
-    video.release()
-    return fps
+
+@app.route('/task-stream/<task_id>')
+def task_stream(task_id):
+    """
+    Server-sent events with the progress of a task and every label segment as soon as it closes.
+
+    Segment events carry their number as event id, so a reconnecting client only gets the segments
+    after its Last-Event-ID. Tasks only publish their last PROGRESS_SEGMENTS segments: a new client
+    starts with those, and one that missed older segments gets them once the task is done. Streams
+    end after STREAM_MAX_SECONDS and the client reconnects, so an unknown task id, which stays
+    PENDING, never holds a web worker for long.
+    """
+    results_url = url_for('task_status', task_id=task_id)
+    resuming = 'Last-Event-ID' in request.headers
+    try:
+        resume_from = max(int(request.headers.get('Last-Event-ID', 0)), 0)
+    except ValueError:
+        resume_from = 0
+
+    def event(name, data, event_id=None):
+        prefix = f"id: {event_id}\n" if event_id is not None else ''
+        return f"{prefix}event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    def events():
+        sent = resume_from
+        skip_ahead = not resuming
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        yield f"retry: {int(PROGRESS_INTERVAL * 1000)}\n\n"
+        while time.monotonic() < deadline:
+            task = celery.AsyncResult(task_id)
+            state = task.state
+            if state == 'FAILURE':
+                yield event('error', {'message': str(task.info)})
+                return
+
+            progress = dict(task.info) if state == 'PROGRESS' else {}
+            if state == 'SUCCESS':
+                segments, offset = task.result[0], 0
+            else:
+                segments, offset = progress.pop('segments', []), progress.pop('segments_offset', 0)
+            if skip_ahead and state == 'PROGRESS':
+                sent, skip_ahead = max(sent, offset), False
+            # Segments published after a gap wait for the final results, so none is skipped
+            if offset <= sent:
+                for number, segment in enumerate(segments[sent - offset:], sent + 1):
+                    yield event('segment', segment, number)
+                sent = max(sent, offset + len(segments))
+
+            if state == 'SUCCESS':
+                yield event('done', {'url': results_url})
+                return
+            yield event('progress', dict(progress, state=state))
+            time.sleep(PROGRESS_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/reaggregate')
+def reaggregate_job(job_id):
+    """
+    Rebuild the segments of a finished job from its stored logits, without running the model.
+
+    Query parameters: smoothing (none, majority or median), window (frames), confidence (minimum
+    top probability of a frame) and min_segment (seconds).
+    """
+    # numpy is only needed here, keep it out of the web process until then
+    from logit_store import SMOOTHING_MODES, MAX_SMOOTHING_WINDOW, load_logits, reaggregate
+
+    try:
+        frame_indices, logits, meta = load_logits(workspace_path(FRAMES_FOLDER, job_id))
+    except (ValueError, FileNotFoundError):
+        return jsonify(error=f"No stored logits for job '{job_id}'"), 404
+
+    smoothing = request.args.get('smoothing', 'none')
+    if smoothing not in SMOOTHING_MODES:
+        return jsonify(error=f"smoothing must be one of {', '.join(SMOOTHING_MODES)}"), 400
+    try:
+        window = max(int(request.args.get('window', 1)), 1)
+        confidence_floor = float(request.args.get('confidence', 0.0))
+        min_segment_seconds = float(request.args.get('min_segment', 0.0))
+    except ValueError:
+        return jsonify(error="window, confidence and min_segment must be numbers"), 400
+    if window > MAX_SMOOTHING_WINDOW:
+        return jsonify(error=f"window must be at most {MAX_SMOOTHING_WINDOW} frames"), 400
+
+    started = time.perf_counter()
+    segments, label_occurrences = reaggregate(frame_indices, logits, meta['fps'], smoothing, window,
+                                              confidence_floor, min_segment_seconds)
+    return jsonify(segments=segments, label_occurrences=label_occurrences, frames=len(frame_indices),
+                   elapsed_ms=(time.perf_counter() - started) * 1000)
+
+def render_results(results):
+    return render_template('results.html', predictions=results[0],
+                           label_occurrences=results[1],
+                           example_images=results[2],
+                           class_description=description_index().get_many(results[2]),
+                           stats=results[3] if len(results) > 3 else {})
+
+def save_upload(file, upload_folder, chunk_size=1 << 20):
+    """
+    Stream an uploaded file to disk, naming it after the SHA-256 of its content.
+
+    Identical uploads end up in the same file and different uploads can never overwrite each other.
+
+    :return: Tuple (path, digest) of the stored video.
+    """
+    extension = os.path.splitext(file.filename)[1].lower()
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+            digest.update(chunk)
+            f.write(chunk)
+
+    video_sha256 = digest.hexdigest()
+    video_path = os.path.join(upload_folder, video_sha256 + extension)
+    if os.path.exists(video_path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, video_path)
+    return video_path, video_sha256
+
+def parse_sampling_options(form):
+    """
+    Read the per-upload sampling rate, mode and similarity threshold, falling back to the defaults.
+    """
+    try:
+        frame_rate = float(form.get('frame_rate') or FRAME_RATE)
+    except ValueError:
+        frame_rate = FRAME_RATE
+    if frame_rate <= 0:
+        frame_rate = FRAME_RATE
+
+    sampling_mode = form.get('sampling_mode') or SAMPLING_MODE
+    if sampling_mode not in SAMPLING_MODES:
+        sampling_mode = SAMPLING_MODE
+
+    try:
+        similarity_threshold = int(form.get('similarity_threshold') or ADAPTIVE_THRESHOLD)
+    except ValueError:
+        similarity_threshold = ADAPTIVE_THRESHOLD
+    return frame_rate, sampling_mode, similarity_threshold
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,316 @@
+import argparse
+import copy
+import os
+import tempfile
+import time
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+# Inference backends accepted by build_backend
+INFERENCE_BACKENDS = ('eager', 'channels_last', 'torchscript', 'quantized', 'quantized_static', 'onnx')
+
+# Input shape CombinedModel is traced, exported and calibrated with
+EXAMPLE_INPUT_SHAPE = (1, 3, 224, 224)
+
+# Side of the downscaled input the cascade's cheap pass runs on
+CASCADE_INPUT_SIZE = 112
+
+class ChannelsLastModule(nn.Module):
+    """
+    Run a model with NHWC activations under inference_mode, which is faster for convolutions on CPU.
+    """
+
+    def __init__(self, model):
+        super(ChannelsLastModule, self).__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        with torch.inference_mode():
+            return self.model(x.contiguous(memory_format=torch.channels_last))
+
+class OnnxRuntimeModule:
+    """
+    Callable wrapper around an ONNX Runtime CPU session that takes and returns torch tensors.
+    """
+
+    def __init__(self, model, example_input):
+        import onnxruntime
+
+        fd, self.onnx_path = tempfile.mkstemp(suffix='.onnx')
+        os.close(fd)
+        torch.onnx.export(model, example_input, self.onnx_path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch', 2: 'height', 3: 'width'}, 'logits': {0: 'batch'}})
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(self.onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, x):
+        logits, = self.session.run(None, {'input': x.detach().cpu().numpy()})
+        return torch.from_numpy(logits)
+
+    def eval(self):
+        return self
+
+class CascadeCounters:
+    """
+    Frame counters of a CascadeModule, kept per analyze_video call so concurrent calls sharing the
+    module do not mix their statistics.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.escalated = 0
+        self.audited = 0
+        self.audit_agreed = 0
+        self.confident_seen = 0
+
+class CascadeModule:
+    """
+    Run a backend on a downscaled copy of every frame first, and only send the frames it is unsure
+    about through the full-resolution pass.
+
+    A frame is unsure when the probabilities of its two most likely classes are less than `margin`
+    apart. Every `audit_every`-th confident frame goes through the full pass as well, to measure how
+    often the cheap pass agrees with it. Calling the module counts frames in its own counters until
+    reset_stats is called, session() gives a caller counters of its own.
+    """
+
+    def __init__(self, model, margin=0.2, input_size=CASCADE_INPUT_SIZE, audit_every=50):
+        self.model = model
+        self.margin = margin
+        self.input_size = input_size
+        self.audit_every = audit_every
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.counters = CascadeCounters()
+
+    def session(self):
+        """
+        :return: Callable running this cascade with counters of its own, see CascadeSession.
+        """
+        return CascadeSession(self)
+
+    def __call__(self, x):
+        return self.run(x, self.counters)
+
+    def run(self, x, counters):
+        small = F.interpolate(x, size=(self.input_size, self.input_size), mode='area')
+        logits = self.model(small).float()
+        top2 = torch.softmax(logits, dim=1).topk(2, dim=1).values
+        unsure = (top2[:, 0] - top2[:, 1]) < self.margin
+
+        audit = torch.zeros_like(unsure)
+        if self.audit_every:
+            confident = (~unsure).nonzero().flatten()
+            seen = counters.confident_seen + torch.arange(len(confident))
+            audit[confident[seen % self.audit_every == 0]] = True
+            counters.confident_seen += len(confident)
+
+        full = unsure | audit
+        if full.any():
+            full_logits = self.model(x[full]).float()
+            counters.audit_agreed += int((full_logits[audit[full]].argmax(dim=1)
+                                          == logits[audit].argmax(dim=1)).sum())
+            # Backends may return inference-mode tensors, which cannot be updated in place
+            logits = logits.clone()
+            logits[full] = full_logits
+
+        counters.frames += len(x)
+        counters.escalated += int(unsure.sum())
+        counters.audited += int(audit.sum())
+        return logits
+
+    def eval(self):
+        return self
+
+    def stats(self, counters=None):
+        counters = counters or self.counters
+        return {
+            'cascade_margin': self.margin,
+            'cascade_frames': counters.frames,
+            'cascade_escalated': counters.escalated,
+            'cascade_rate': counters.escalated / counters.frames if counters.frames else 0.0,
+            'cascade_audited': counters.audited,
+            'cascade_audit_agreed': counters.audit_agreed,
+            'cascade_agreement': counters.audit_agreed / counters.audited if counters.audited else None,
+        }
+
+class CascadeSession:
+    """
+    A CascadeModule with counters private to one caller, such as one analyze_video call.
+    """
+
+    def __init__(self, cascade):
+        self.cascade = cascade
+        self.counters = CascadeCounters()
+
+    def __call__(self, x):
+        return self.cascade.run(x, self.counters)
+
+    def eval(self):
+        return self
+
+    def stats(self):
+        return self.cascade.stats(self.counters)
+
+def build_backend(model, name, calibration_inputs=None):
+    """
+    Wrap an eager CombinedModel in an optimized CPU inference backend.
+
+    The eager model is left untouched so it can still serve as the parity reference.
+
+    :param model: Eager model in evaluation mode.
+    :param name: One of INFERENCE_BACKENDS.
+    :param calibration_inputs: List of input batches used to calibrate 'quantized_static',
+                               representative frames give much better accuracy than the default.
+    :return: A callable taking a (N, 3, 224, 224) tensor and returning logits.
+    """
+    if name not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of {INFERENCE_BACKENDS}")
+
+    model.eval()
+    example_input = torch.rand(EXAMPLE_INPUT_SHAPE)
+
+    if name == 'eager':
+        return model
+
+    if name == 'channels_last':
+        return ChannelsLastModule(copy.deepcopy(model)).eval()
+
+    if name == 'torchscript':
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example_input)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    if name == 'quantized':
+        # Only the linear layers have int8 dynamic kernels, the convolutions stay in float32
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+    if name == 'quantized_static':
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        prepared = prepare_fx(copy.deepcopy(model), get_default_qconfig_mapping('x86'), (example_input,))
+        with torch.no_grad():
+            for batch in calibration_inputs or [example_input]:
+                prepared(batch)
+        return convert_fx(prepared)
+
+    return OnnxRuntimeModule(model, example_input)
+
+def _timed_forward(model, inputs):
+    outputs = []
+    started = time.perf_counter()
+    with torch.no_grad():
+        for batch in inputs:
+            outputs.append(model(batch).float())
+    return torch.cat(outputs), time.perf_counter() - started
+
+def parity_report(reference, candidate, inputs, candidate_inputs=None):
+    """
+    Compare a backend against the reference model on the same inputs.
+
+    :param reference: Eager reference model.
+    :param candidate: Backend returned by build_backend.
+    :param inputs: List of input batches.
+    :param candidate_inputs: Inputs of the candidate when they differ, such as the same frames
+                             preprocessed another way.
+    :return: Dictionary with label agreement, maximum absolute logit drift and timings.
+    """
+    reference_logits, reference_seconds = _timed_forward(reference, inputs)
+    candidate_logits, candidate_seconds = _timed_forward(candidate, candidate_inputs or inputs)
+
+    agreement = (reference_logits.argmax(dim=1) == candidate_logits.argmax(dim=1)).float().mean().item()
+    return {
+        'frames': reference_logits.shape[0],
+        'label_agreement': agreement,
+        'max_logit_drift': (reference_logits - candidate_logits).abs().max().item(),
+        'reference_seconds': reference_seconds,
+        'candidate_seconds': candidate_seconds,
+        'speedup': reference_seconds / candidate_seconds if candidate_seconds else 0.0,
+    }
+
+def compare_backends(model, inputs, names=INFERENCE_BACKENDS):
+    """
+    Build every backend and report its parity with the eager model.
+
+    :return: Dictionary of backend name to parity report, or to an error message if the
+             backend could not be built on this machine.
+    """
+    reports = {}
+    for name in names:
+        try:
+            candidate = build_backend(model, name, calibration_inputs=inputs[:4])
+            # One warm-up pass so tracing and allocator costs are not timed
+            with torch.no_grad():
+                candidate(inputs[0])
+            reports[name] = parity_report(model, candidate, inputs)
+        except Exception as e:
+            reports[name] = {'error': str(e)}
+    return reports
+
+if __name__ == '__main__':
+    from model import CombinedModel, load_combined_model
+    from utils import batched, iter_frames, load_image
+    from torchvision import transforms
+
+    parser = argparse.ArgumentParser(description="Check inference backends against the eager model.")
+    parser.add_argument('video', nargs='?', help="Video to sample frames from, random inputs when omitted.")
+    parser.add_argument('--backends', nargs='+', default=list(INFERENCE_BACKENDS), choices=INFERENCE_BACKENDS)
+    parser.add_argument('--frames', type=int, default=64, help="Number of frames to compare on.")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--random-weights', action='store_true', help="Skip loading the trained weights.")
+    parser.add_argument('--cascade-margins', type=float, nargs='*', default=[],
+                        help="Also compare the cascade with these confidence margins against the full model.")
+    parser.add_argument('--check-preprocessing', action='store_true',
+                        help="Compare the frames preprocessed by the pipeline with the PIL transform.")
+    args = parser.parse_args()
+
+    model = CombinedModel(num_classes=23).eval() if args.random_weights else load_combined_model(num_classes=23)
+
+    if args.video:
+        transform = transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor()])
+        frames = [frame for _, (_, _, frame) in zip(range(args.frames), iter_frames(args.video))]
+        inputs = [torch.stack([transform(load_image(frame)) for frame in batch])
+                  for batch in batched(frames, args.batch_size)]
+    else:
+        inputs = [torch.rand(args.batch_size, *EXAMPLE_INPUT_SHAPE[1:])
+                  for _ in range(max(args.frames // args.batch_size, 1))]
+
+    for name, report in compare_backends(model, inputs, args.backends).items():
+        if 'error' in report:
+            print(f"{name:>16}: unavailable ({report['error']})")
+        else:
+            print(f"{name:>16}: agreement {report['label_agreement']:.2%}, max drift {report['max_logit_drift']:.4f}, "
+                  f"{report['candidate_seconds']:.2f}s ({report['speedup']:.2f}x)")
+
+    if args.video and args.check_preprocessing:
+        # The pipeline resizes with OpenCV instead of the PIL transform, the eager model runs both
+        from pipeline import preprocess_batch
+
+        pipeline_inputs = [preprocess_batch(batch) for batch in batched(frames, args.batch_size)]
+        differences = torch.cat([(a - b).abs().flatten() for a, b in zip(inputs, pipeline_inputs)])
+        report = parity_report(model, model, inputs, pipeline_inputs)
+        print(f"{'preprocessing':>16}: agreement {report['label_agreement']:.2%}, "
+              f"max drift {report['max_logit_drift']:.4f}, input drift {differences.mean().item():.4f} mean "
+              f"{differences.max().item():.4f} max")
+
+    # The cascade runs on top of every backend, both passes are checked against the eager model
+    for name in args.backends if args.cascade_margins else ():
+        try:
+            backend = build_backend(model, name, calibration_inputs=inputs[:4])
+        except Exception as e:
+            print(f"{f'cascade {name}':>16}: unavailable ({e})")
+            continue
+        for margin in args.cascade_margins:
+            cascade = CascadeModule(backend, margin, audit_every=0)
+            try:
+                report = parity_report(model, cascade, inputs)
+            except Exception as e:
+                print(f"{f'cascade {name} {margin:g}':>16}: failed ({e})")
+                continue
+            print(f"{f'cascade {name} {margin:g}':>16}: agreement {report['label_agreement']:.2%}, "
+                  f"escalated {cascade.stats()['cascade_rate']:.2%}, "
+                  f"{report['candidate_seconds']:.2f}s ({report['speedup']:.2f}x)")
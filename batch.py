@@ -0,0 +1,176 @@
+"""
+Offline batch processing of archived videos, without the web tier, Redis or Celery.
+
+Every video matched by the given directories or glob patterns is run through the pipeline on a
+pool of processes, and one JSON line per video is appended to the output file as soon as it is
+done. Videos that already have a result in the output file are skipped, so an interrupted run is
+resumed by running the same command again:
+
+    python batch.py /archive/videos "/archive/2023/**/*.avi" --output results.jsonl --workers 4
+"""
+import argparse
+import functools
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from aggregate import summarize_labels
+from backends import build_backend, CascadeModule
+from model import load_combined_model
+from pipeline import analyze_video, video_properties, configure_threads
+from utils import SAMPLING_MODES
+
+# Files picked up when a directory is given
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.mpg', '.mpeg', '.wmv', '.webm')
+
+# Model shared by the pool processes, loaded by the parent before they are forked
+_model = None
+
+def find_videos(patterns, extensions=VIDEO_EXTENSIONS):
+    """
+    Expand directories (searched recursively) and glob patterns into a sorted list of video paths.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for directory, _, filenames in os.walk(pattern):
+                paths.update(os.path.join(directory, filename) for filename in filenames
+                             if filename.lower().endswith(extensions))
+        else:
+            paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(os.path.abspath(path) for path in paths)
+
+def read_finished(output_path):
+    """
+    Collect the videos that already have a result in a JSONL output file.
+
+    A line cut short by an interrupted run is removed, so that appending continues on a fresh line.
+    Videos that failed are not considered finished and are retried.
+
+    :return: Set of absolute video paths.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+            data = data[:data.rfind(b'\n') + 1]
+
+    finished = set()
+    for line in data.decode('utf-8').splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if 'error' not in record:
+            finished.add(record['video'])
+    return finished
+
+def load_model(inference_backend='eager', cascade_margin=-1):
+    model = build_backend(load_combined_model(num_classes=23), inference_backend)
+    if cascade_margin >= 0:
+        model = CascadeModule(model, cascade_margin)
+    return model
+
+def process_video(video_path, options):
+    """
+    Run the pipeline over one video with the model of this process.
+
+    :param options: Keyword arguments of analyze_video.
+    :return: JSON-serializable result record, with an 'error' key when the video could not be processed.
+    """
+    started = time.perf_counter()
+    try:
+        fps, _ = video_properties(video_path)
+        if not fps:
+            raise ValueError("Could not extract FPS from the video")
+        (frame_indices, labels, _), _, stats = analyze_video(_model, video_path, **options)
+        segments, label_occurrences, first_frames = summarize_labels(frame_indices, labels, fps)
+    except Exception as e:
+        return {'video': video_path, 'error': f"{type(e).__name__}: {e}",
+                'seconds': time.perf_counter() - started}
+    return {
+        'video': video_path,
+        'fps': fps,
+        'segments': segments,
+        'label_occurrences': label_occurrences,
+        # Frame index of the first frame of every label, the example shown on the results page
+        'example_frames': first_frames,
+        'stats': stats,
+        'seconds': time.perf_counter() - started,
+    }
+
+def run_batch(videos, output_path, workers, options, inference_backend='eager', cascade_margin=-1):
+    """
+    Process videos on a pool of forked processes and append their results to output_path.
+
+    The model is loaded once, before the pool starts, and the processes share its weights
+    copy-on-write instead of loading one copy each.
+
+    :return: Dictionary with the number of videos processed and failed, the frames sampled and
+             the aggregate frames per second.
+    """
+    global _model
+
+    # The parent only loads the model, and a single-threaded torch runtime is safe to fork
+    configure_threads(1)
+    _model = load_model(inference_backend, cascade_margin)
+
+    workers = max(1, min(workers, len(videos)))
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    totals = {'videos': 0, 'failed': 0, 'frames': 0}
+    started = time.perf_counter()
+    with multiprocessing.get_context('fork').Pool(workers, configure_threads, (num_threads,)) as pool, \
+            open(output_path, 'a', encoding='utf-8') as output:
+        results = pool.imap_unordered(functools.partial(process_video, options=options), videos)
+        for done, record in enumerate(results, 1):
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+
+            totals['videos'] += 1
+            if 'error' in record:
+                totals['failed'] += 1
+            else:
+                totals['frames'] += record['stats'].get('frames_sampled', 0)
+            elapsed = time.perf_counter() - started
+            print(f"[{done}/{len(videos)}] {record['video']}: {record.get('error', 'done')} "
+                  f"({totals['frames'] / elapsed:.1f} frames/sec overall)", file=sys.stderr)
+
+    totals['seconds'] = time.perf_counter() - started
+    totals['frames_per_sec'] = totals['frames'] / totals['seconds'] if totals['seconds'] else 0.0
+    return totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize every video of directories or glob patterns.")
+    parser.add_argument('inputs', nargs='+', help="Video directories (searched recursively) or glob patterns.")
+    parser.add_argument('--output', default='results.jsonl', help="JSONL file the results are appended to.")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                        help="Processes, the cores are split evenly between them.")
+    parser.add_argument('--frame-rate', type=float, default=float(os.environ.get('FRAME_RATE', 1)))
+    parser.add_argument('--sampling-mode', choices=SAMPLING_MODES, default=os.environ.get('SAMPLING_MODE', 'grab'))
+    parser.add_argument('--similarity-threshold', type=int, default=int(os.environ.get('ADAPTIVE_THRESHOLD', -1)))
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('BATCH_SIZE', 16)))
+    parser.add_argument('--preprocess-threads', type=int, default=int(os.environ.get('PREPROCESS_THREADS', 2)))
+    parser.add_argument('--inference-backend', default=os.environ.get('INFERENCE_BACKEND', 'eager'))
+    parser.add_argument('--cascade-margin', type=float, default=float(os.environ.get('CASCADE_MARGIN', -1)))
+    parser.add_argument('--no-resume', action='store_true', help="Process videos that already have a result too.")
+    args = parser.parse_args()
+
+    videos = find_videos(args.inputs)
+    if not args.no_resume:
+        finished = read_finished(args.output)
+        print(f"Skipping {len([video for video in videos if video in finished])} videos already in {args.output}",
+              file=sys.stderr)
+        videos = [video for video in videos if video not in finished]
+    if not videos:
+        print("Nothing to process", file=sys.stderr)
+        sys.exit(0)
+
+    options = dict(frame_rate=args.frame_rate, sampling_mode=args.sampling_mode,
+                   similarity_threshold=args.similarity_threshold, batch_size=args.batch_size,
+                   preprocess_threads=args.preprocess_threads)
+    totals = run_batch(videos, args.output, args.workers, options, args.inference_backend, args.cascade_margin)
+    print(json.dumps(totals))
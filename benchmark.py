@@ -0,0 +1,417 @@
+"""
+Offline benchmark of the video -> summary pipeline.
+
+Generates synthetic videos, runs every stage with a randomly initialised CombinedModel and prints
+machine-readable JSON, so no network, Redis or trained weights are needed. Typical use:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json   # exits with 1 on a throughput regression
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from model import CombinedModel
+from aggregate import summarize_labels
+from inference_server import BatchingInferenceServer
+from pipeline import (transform, preprocess_batch, iter_preprocessed, analyze_video, summarize_video, plan_chunks,
+                      merge_chunks, video_properties)
+from utils import (iter_frames, save_frame, load_image, predict_logits, run_model, batched, index_to_class,
+                   sampling_step,
+                   class_to_index, group_consecutive_frames, count_label_occurrences)
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+def make_synthetic_video(path, seconds, width, height, fps, seed=0, scene_seconds=5):
+    """
+    Write a deterministic test video: a drifting gradient with moving shapes on a background
+    that changes every scene_seconds, plus a little noise so the encoder has real work to do.
+    """
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Could not open a video writer for {path}")
+
+    gradient = np.tile(np.linspace(0, 255, width, dtype=np.float32), (height, 1))
+    total_frames = int(seconds * fps)
+    for frame_index in range(total_frames):
+        scene = frame_index // int(scene_seconds * fps)
+        background = np.array([(scene * 67) % 256, (scene * 131) % 256, (scene * 29) % 256], dtype=np.float32)
+        frame = (0.5 * gradient[..., None] + 0.5 * background).astype(np.uint8)
+        frame = np.roll(frame, frame_index * 2, axis=1)
+
+        center = (int(width / 2 + width / 3 * np.sin(frame_index / fps)), int(height / 2))
+        cv2.circle(frame, center, max(height // 8, 4), (255, 255, 255), -1)
+        noise = rng.integers(0, 8, size=frame.shape, dtype=np.uint8)
+        writer.write(cv2.add(frame, noise))
+    writer.release()
+    return total_frames
+
+class SceneModel(torch.nn.Module):
+    """
+    Stand-in for CombinedModel that labels a frame by its mean brightness, so the scenes of
+    make_synthetic_video get labels of their own and segments change within the video.
+    """
+
+    def __init__(self, num_classes):
+        super(SceneModel, self).__init__()
+        self.num_classes = num_classes
+
+    def forward(self, x):
+        bins = (x.mean(dim=(1, 2, 3)) * self.num_classes).long().clamp(0, self.num_classes - 1)
+        return torch.nn.functional.one_hot(bins, self.num_classes).float()
+
+def check_chunks(video_path, model, frame_rate, num_chunks, workdir, batch_size=16):
+    """
+    Process a video serially and in chunks, as PARALLEL_MODE does, and compare the merged results.
+
+    :return: Dictionary with the number of chunks and segments, the segments that span a chunk
+             boundary, and whether segments, label counts and example images are identical.
+    """
+    fps, _ = video_properties(video_path)
+    options = dict(frame_rate=frame_rate, batch_size=batch_size, preprocess_threads=0)
+    serial_dir, chunked_dir = os.path.join(workdir, 'serial'), os.path.join(workdir, 'chunked')
+    os.makedirs(serial_dir)
+    os.makedirs(chunked_dir)
+
+    predictions, example_frames, stats = analyze_video(model, video_path, **options)
+    serial = merge_chunks([summarize_video(predictions, example_frames, fps, serial_dir) + (stats,)], fps)
+
+    chunks = plan_chunks(video_path, frame_rate, num_chunks)
+    chunk_results = []
+    for sample_range in chunks:
+        predictions, example_frames, stats = analyze_video(model, video_path, sample_range=sample_range, **options)
+        chunk_results.append(summarize_video(predictions, example_frames, fps, chunked_dir, '', sample_range[0])
+                             + (stats,))
+    chunked = merge_chunks(chunk_results, fps)
+
+    boundaries = [int(round(first * sampling_step(fps, frame_rate))) for first, _ in chunks[1:]]
+    images_equal = serial[2] == chunked[2]
+    for image_file in serial[2].values() if images_equal else ():
+        with open(os.path.join(serial_dir, image_file), 'rb') as serial_image, \
+                open(os.path.join(chunked_dir, image_file), 'rb') as chunked_image:
+            images_equal = images_equal and serial_image.read() == chunked_image.read()
+    return {
+        'chunks': len(chunks),
+        'segments': len(serial[0]),
+        'segments_across_boundaries': sum(1 for segment in serial[0] for boundary in boundaries
+                                          if segment['start_frame'] < boundary <= segment['end_frame']),
+        'segments_equal': serial[0] == chunked[0],
+        'label_occurrences_equal': serial[1] == chunked[1],
+        'example_images_equal': images_equal,
+    }
+
+def _rate(count, seconds):
+    return count / seconds if seconds else 0.0
+
+def bench_video(video_path, model, frame_rate, batch_size, max_inference_frames, workdir, pipeline_threads=2):
+    """
+    Time every stage of the pipeline on one video.
+    """
+    results = {}
+
+    decode_stats = {}
+    frames = list(iter_frames(video_path, frame_rate, 'grab', decode_stats))
+    results['decode'] = {
+        'frames_read': decode_stats['frames_read'],
+        'frames_sampled': decode_stats['frames_sampled'],
+        'seconds': decode_stats['decode_seconds'],
+        'frames_per_sec': decode_stats['decode_fps'],
+        'sampled_per_sec': decode_stats['sampled_fps'],
+    }
+
+    # The JPEG round trip the pipeline used to make for every sampled frame
+    started = time.perf_counter()
+    files = [save_frame(frame, workdir, frame_index) for frame_index, _, frame in frames]
+    write_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for frame_file in files:
+        Image.open(os.path.join(workdir, frame_file)).convert('RGB').load()
+    read_seconds = time.perf_counter() - started
+    results['jpeg_write'] = {'frames': len(files), 'seconds': write_seconds,
+                             'frames_per_sec': _rate(len(files), write_seconds)}
+    results['jpeg_read'] = {'frames': len(files), 'seconds': read_seconds,
+                            'frames_per_sec': _rate(len(files), read_seconds)}
+
+    started = time.perf_counter()
+    for _, _, frame in frames:
+        transform(load_image(frame))
+    preprocess_seconds = time.perf_counter() - started
+    results['preprocess'] = {'frames': len(frames), 'seconds': preprocess_seconds,
+                             'frames_per_sec': _rate(len(frames), preprocess_seconds)}
+
+    started = time.perf_counter()
+    for batch in batched([frame for _, _, frame in frames], batch_size):
+        preprocess_batch(batch)
+    preprocess_seconds = time.perf_counter() - started
+    results['preprocess_cv2'] = {'frames': len(frames), 'seconds': preprocess_seconds,
+                                 'frames_per_sec': _rate(len(frames), preprocess_seconds)}
+
+    inference_frames = [frame for _, _, frame in frames[:max_inference_frames]]
+    results['inference'] = {}
+    for size in sorted({1, batch_size}):
+        started = time.perf_counter()
+        for batch in batched(inference_frames, size):
+            predict_logits(model, batch, transform)
+        seconds = time.perf_counter() - started
+        results['inference'][f'batch_{size}'] = {'frames': len(inference_frames), 'seconds': seconds,
+                                                 'frames_per_sec': _rate(len(inference_frames), seconds)}
+
+    # Preprocessing and inference one after another, then overlapped by the pipelined executor
+    results['pipeline'] = {}
+    for threads in (0, pipeline_threads):
+        started = time.perf_counter()
+        for _, images in iter_preprocessed(iter(frames[:max_inference_frames]), batch_size, threads):
+            run_model(model, images)
+        seconds = time.perf_counter() - started
+        results['pipeline'][f'threads_{threads}'] = {'frames': len(inference_frames), 'seconds': seconds,
+                                                     'frames_per_sec': _rate(len(inference_frames), seconds)}
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+def bench_aggregation(num_frames, fps=30, segment_length=40, seed=0):
+    """
+    Time the aggregation of a long synthetic prediction run, from the label-index arrays the
+    pipeline produces and from a {frame index: label} dictionary.
+    """
+    rng = random.Random(seed)
+    labels = list(index_to_class.values())
+    predictions = {}
+    label = labels[0]
+    for frame_index in range(num_frames):
+        if frame_index % segment_length == 0:
+            label = rng.choice(labels)
+        predictions[frame_index * fps] = label
+
+    started = time.perf_counter()
+    segments = group_consecutive_frames(predictions, fps)
+    group_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    count_label_occurrences(predictions)
+    count_seconds = time.perf_counter() - started
+
+    frame_indices = np.fromiter(predictions, dtype=np.int64, count=len(predictions))
+    label_indices = np.fromiter((class_to_index[label] for label in predictions.values()),
+                                dtype=np.int8, count=len(predictions))
+    started = time.perf_counter()
+    summarize_labels(frame_indices, label_indices, fps)
+    array_seconds = time.perf_counter() - started
+    return {
+        'frames': num_frames,
+        'segments': len(segments),
+        'group_seconds': group_seconds,
+        'count_seconds': count_seconds,
+        'frames_per_sec': _rate(num_frames, group_seconds + count_seconds),
+        'arrays': {'seconds': array_seconds, 'frames_per_sec': _rate(num_frames, array_seconds)},
+    }
+
+def bench_inference_server(model, jobs, batch_size, batches_per_job, max_batch_size=32, max_latency=0.01):
+    """
+    Run `jobs` threads that each send batches_per_job batches of batch_size random frames, first
+    straight to the model and then through a BatchingInferenceServer.
+    """
+    images = torch.rand(batch_size, 3, 224, 224)
+
+    def run(target):
+        threads = [threading.Thread(target=lambda: [run_model(target, images) for _ in range(batches_per_job)])
+                   for _ in range(jobs)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    frames = jobs * batch_size * batches_per_job
+    direct_seconds = run(model)
+    server = BatchingInferenceServer(model, max_batch_size, max_latency)
+    server_seconds = run(server)
+    server.close()
+    stats = server.stats()
+    return {
+        'jobs': jobs,
+        'frames': frames,
+        'direct': {'seconds': direct_seconds, 'frames_per_sec': _rate(frames, direct_seconds)},
+        'server': {'seconds': server_seconds, 'frames_per_sec': _rate(frames, server_seconds),
+                   'mean_batch_size': stats['mean_batch_size'], 'utilization': stats['utilization']},
+    }
+
+# Startup of each deployment role, see the Dockerfile. A worker process that loads its own model
+# ('worker_with_model', random weights) costs the model's memory again, one using the inference
+# server does not
+ROLES = {
+    'web': 'import app',
+    'worker': 'import tasks',
+    'worker_with_model': 'import tasks; from model import CombinedModel; CombinedModel(num_classes=23).eval()',
+}
+
+# Modules the web role should never load
+HEAVY_MODULES = ('torch', 'torchvision', 'cv2', 'matplotlib', 'numpy', 'transformers')
+
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+started = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - started
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'import_seconds': seconds,
+                  'peak_rss_mb': peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024,
+                  'heavy_modules': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def bench_startup(roles=ROLES):
+    """
+    Start every role in a fresh interpreter and report its startup time and memory.
+    """
+    results = {}
+    for role, statement in roles.items():
+        script = STARTUP_SCRIPT.format(statement=statement, heavy=HEAVY_MODULES)
+        completed = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        if completed.returncode:
+            results[role] = {'error': completed.stderr.strip().splitlines()[-1:]}
+        else:
+            results[role] = json.loads(completed.stdout.strip().splitlines()[-1])
+    return results
+
+def throughputs(report, prefix=''):
+    """
+    Flatten every frames_per_sec value of a report into {dotted.path: value}.
+    """
+    values = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            values.update(throughputs(value, f'{prefix}{key}.'))
+        elif key == 'frames_per_sec':
+            values[prefix.rstrip('.')] = value
+    return values
+
+def compare(report, baseline, tolerance):
+    """
+    :return: List of (path, baseline, current) throughputs that dropped by more than tolerance.
+    """
+    current = throughputs(report['benchmarks'])
+    regressions = []
+    for path, reference in throughputs(baseline['benchmarks']).items():
+        if path in current and reference and current[path] < reference * (1 - tolerance):
+            regressions.append((path, reference, current[path]))
+    return regressions
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the video summary pipeline.")
+    parser.add_argument('--lengths', type=float, nargs='+', default=[10, 60], help="Video lengths in seconds.")
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+', default=[(640, 480), (1280, 720)])
+    parser.add_argument('--fps', type=float, nargs='+', default=[25, 30])
+    parser.add_argument('--frame-rate', type=float, default=1, help="Frames sampled per second of video.")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-inference-frames', type=int, default=32,
+                        help="Cap on the frames sent through the model per video, inference dominates run time.")
+    parser.add_argument('--aggregation-frames', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=None, help="torch.set_num_threads value.")
+    parser.add_argument('--preprocess-threads', type=int, default=2, help="Preprocessing threads of the pipeline.")
+    parser.add_argument('--server-jobs', type=int, default=4,
+                        help="Concurrent jobs of the inference server benchmark, 0 skips it.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+    parser.add_argument('--compare', help="Baseline JSON report to check for throughput regressions.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative throughput drop.")
+    parser.add_argument('--startup-only', action='store_true',
+                        help="Only measure the startup time and memory of the web and worker roles.")
+    parser.add_argument('--check-chunks', type=int, default=0, metavar='CHUNKS',
+                        help="Only check that a video split into this many chunks gives the results of a "
+                             "serial run, exits with 1 when it does not.")
+    args = parser.parse_args()
+
+    if args.startup_only:
+        print(json.dumps(bench_startup(), indent=2))
+        return
+
+    if args.check_chunks:
+        with tempfile.TemporaryDirectory() as workdir:
+            video_path = os.path.join(workdir, 'chunks.mp4')
+            (width, height), fps = args.resolutions[0], args.fps[0]
+            make_synthetic_video(video_path, max(args.lengths), width, height, fps, seed=args.seed)
+            report = check_chunks(video_path, SceneModel(len(index_to_class)).eval(), args.frame_rate,
+                                  args.check_chunks, workdir, args.batch_size)
+        print(json.dumps(report, indent=2))
+        # Without a segment spanning a boundary the stitching of segments is not exercised
+        if not (report['segments_equal'] and report['label_occurrences_equal'] and report['example_images_equal']
+                and report['segments_across_boundaries']):
+            sys.exit(1)
+        return
+
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = CombinedModel(num_classes=len(index_to_class)).eval()
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+        },
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'benchmarks': {'videos': {}},
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for seconds in args.lengths:
+            for width, height in args.resolutions:
+                for fps in args.fps:
+                    name = f'{seconds:g}s_{width}x{height}_{fps:g}fps'
+                    video_path = os.path.join(workdir, f'{name}.mp4')
+                    make_synthetic_video(video_path, seconds, width, height, fps, seed=args.seed)
+                    frames_dir = os.path.join(workdir, name)
+                    report['benchmarks']['videos'][name] = bench_video(
+                        video_path, model, args.frame_rate, args.batch_size, args.max_inference_frames, frames_dir,
+                        args.preprocess_threads)
+                    print(f"Benchmarked {name}", file=sys.stderr)
+
+    report['benchmarks']['aggregation'] = bench_aggregation(args.aggregation_frames, seed=args.seed)
+    if args.server_jobs:
+        report['benchmarks']['inference_server'] = bench_inference_server(
+            model, args.server_jobs, max(args.batch_size // args.server_jobs, 1),
+            max(args.max_inference_frames // args.batch_size, 1))
+    report['benchmarks']['startup'] = bench_startup()
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for path, reference, current in regressions:
+            print(f"Regression in {path}: {reference:.1f} -> {current:.1f} frames/sec", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+from celery import Celery
+from result_cache import ResultCache
+from utils import PREPROCESSING_VERSION
+from weights import weights_digest
+
+# Configuration shared by the web process (app.py) and the workers (tasks.py). The web process
+# imports this module, so it must not import torch, OpenCV or the model.
+
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')  # Update this if using a cloud service
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')  # Update this if using a cloud service
+
+# Every task works in its own frames workspace, so several can safely run side by side
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 1))
+
+celery = Celery('video_summary', broker=CELERY_BROKER_URL)
+# Old-style setting names, Celery refuses to mix them with new-style ones
+celery.conf.update(CELERY_RESULT_BACKEND=CELERY_RESULT_BACKEND, CELERYD_CONCURRENCY=WORKER_CONCURRENCY,
+                   CELERYD_PREFETCH_MULTIPLIER=1, CELERY_TRACK_STARTED=True)
+
+# Name of the task the web process submits, defined in tasks.py
+PROCESS_VIDEO_TASK = 'tasks.process_video'
+
+# Minimum number of seconds between two progress updates of a task, and between two polls of
+# the streaming endpoint
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 1.0))
+# Progress updates carry the last PROGRESS_SEGMENTS closed segments rather than all of them, a
+# stream that falls further behind sends the rest from the final results
+PROGRESS_SEGMENTS = int(os.environ.get('PROGRESS_SEGMENTS', 100))
+
+# Path for uploaded videos and extracted frames
+UPLOAD_FOLDER = 'uploads/'
+FRAMES_FOLDER = 'static/frames/'
+# Chunked uploads in progress, see uploads.py
+UPLOAD_SESSIONS_FOLDER = os.path.join(UPLOAD_FOLDER, 'sessions')
+
+# Default frame sampling, both can be overridden per upload
+FRAME_RATE = float(os.environ.get('FRAME_RATE', 1))
+SAMPLING_MODE = os.environ.get('SAMPLING_MODE', 'grab')
+
+# Maximum signature distance (in bits) under which a frame reuses the previous prediction,
+# unset or negative disables adaptive sampling
+ADAPTIVE_THRESHOLD = int(os.environ.get('ADAPTIVE_THRESHOLD', -1))
+
+# CPU inference backend, see backends.py; run `python backends.py <video>` to check parity first
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'eager')
+
+# Run every frame through the model at half resolution first and only repeat the frames whose two
+# most likely classes are less than CASCADE_MARGIN apart at full resolution, negative disables it
+CASCADE_MARGIN = float(os.environ.get('CASCADE_MARGIN', -1))
+
+# Finished results keyed by video content and configuration
+result_cache = ResultCache()
+
+# Ensure directories exist
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(FRAMES_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_SESSIONS_FOLDER, exist_ok=True)
+
+def current_weights_digest():
+    """
+    Digest of the model weights, as published by the workers when this process has no weights.
+    """
+    return weights_digest() or result_cache.current_weights()
+
+def results_config(frame_rate, sampling_mode, similarity_threshold):
+    """
+    Everything besides the video content that changes the results of process_video.
+    """
+    return {
+        'weights_sha256': current_weights_digest(),
+        'inference_backend': INFERENCE_BACKEND,
+        'cascade_margin': CASCADE_MARGIN,
+        'preprocessing': PREPROCESSING_VERSION,
+        'frame_rate': frame_rate,
+        'sampling_mode': sampling_mode,
+        'similarity_threshold': similarity_threshold,
+    }
@@ -0,0 +1,164 @@
+"""
+Frozen index of the label descriptions shown next to the results.
+
+Descriptions come from label_description.csv (Label and Description columns) when it exists, the
+built-in ones below otherwise. The index is built once per process and never loads torch or
+transformers; embeddings of the descriptions are precomputed offline with
+
+    python descriptions.py --embed <fine-tuned BERT directory>
+"""
+import argparse
+import csv
+import functools
+import os
+from types import MappingProxyType
+
+DESCRIPTIONS_CSV = os.environ.get('DESCRIPTIONS_CSV', 'label_description.csv')
+DESCRIPTION_EMBEDDINGS = os.environ.get('DESCRIPTION_EMBEDDINGS', 'cache/description_embeddings.npz')
+
+DEFAULT_DESCRIPTION = "No description available for this label."
+
+_BUILTIN_DESCRIPTIONS = {
+    "lower-gi-tract/anatomical-landmarks/cecum": "The cecum is the beginning of the large intestine and is a critical anatomical landmark in the lower gastrointestinal tract. It plays a role in absorbing fluids and salts that remain after intestinal digestion and absorption.",
+    "lower-gi-tract/anatomical-landmarks/ileum": "The ileum is the final section of the small intestine, where absorption of vitamin B12 and bile salts occurs. It is a key anatomical landmark in the lower gastrointestinal tract.",
+    "lower-gi-tract/anatomical-landmarks/retroflex-rectum": "Retroflex view of the rectum is an endoscopic technique used to inspect the rectum more thoroughly, especially for polyps or other abnormalities.",
+    "lower-gi-tract/pathological-findings/hemorrhoids": "Hemorrhoids are swollen veins in the lower rectum or anus, often causing discomfort, itching, or bleeding. They are a common pathological finding in the lower gastrointestinal tract.",
+    "lower-gi-tract/pathological-findings/polyps": "Polyps are abnormal growths of tissue that form on the lining of the colon or rectum. They can vary in size and have the potential to develop into colorectal cancer if left untreated.",
+    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-0-1": "Ulcerative Colitis Grade 0-1 indicates minimal to mild inflammation of the colon, characterized by superficial ulcerations and erythema. It is an early stage of the disease in the lower gastrointestinal tract.",
+    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1": "Ulcerative Colitis Grade 1 is marked by mild inflammation in the colon with superficial ulcerations and erythema. It is an early stage of ulcerative colitis.",
+    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1-2": "Ulcerative Colitis Grade 1-2 represents moderate inflammation of the colon, with more pronounced ulcerations and erythema. This stage indicates a progression of the disease.",
+    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2": "Ulcerative Colitis Grade 2 involves moderate inflammation and ulceration in the colon. It is a more advanced stage of the disease, requiring careful monitoring.",
+    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2-3": "Ulcerative Colitis Grade 2-3 indicates severe inflammation with extensive ulceration and erythema. This stage of the disease requires aggressive treatment.",
+    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-3": "Ulcerative Colitis Grade 3 is characterized by severe inflammation, deep ulcerations, and extensive tissue damage in the colon. It is the most advanced stage of the disease.",
+    "lower-gi-tract/quality-of-mucosal-views/bbps-0-1": "The Boston Bowel Preparation Scale (BBPS) score of 0-1 indicates poor bowel preparation, with a significant amount of stool obstructing the view during a colonoscopy, affecting the quality of mucosal views.",
+    "lower-gi-tract/quality-of-mucosal-views/bbps-2-3": "The Boston Bowel Preparation Scale (BBPS) score of 2-3 indicates fair to good bowel preparation, with partial to clear views of the mucosa during a colonoscopy, allowing for a more thorough examination.",
+    "lower-gi-tract/quality-of-mucosal-views/impacted-stool": "Impacted stool refers to a large, hard mass of stool that is stuck in the colon or rectum. It can obscure the view during endoscopic procedures, compromising the quality of mucosal views.",
+    "lower-gi-tract/therapeutic-interventions/dyed-lifted-polyps": "Dyed lifted polyps refer to polyps that have been injected with a dye solution to lift them away from the mucosal layer during an endoscopic procedure, facilitating their removal.",
+    "lower-gi-tract/therapeutic-interventions/dyed-resection-margins": "Dyed resection margins refer to the edges of tissue that have been stained with dye during an endoscopic procedure to ensure that the entire lesion or polyp has been removed.",
+    "upper-gi-tract/anatomical-landmarks/pylorus": "The pylorus is the opening from the stomach into the duodenum (first part of the small intestine). It is an important anatomical landmark in the upper gastrointestinal tract, controlling the passage of stomach contents.",
+    "upper-gi-tract/anatomical-landmarks/retroflex-stomach": "Retroflex view of the stomach is an endoscopic technique used to inspect the upper part of the stomach, especially for detecting abnormalities such as polyps, ulcers, or tumors.",
+    "upper-gi-tract/anatomical-landmarks/z-line": "The Z-line, or squamocolumnar junction, is where the esophagus meets the stomach. It is an important anatomical landmark in the upper gastrointestinal tract, often inspected for signs of Barrett's esophagus or other conditions.",
+    "upper-gi-tract/pathological-findings/barretts": "Barrett's esophagus is a condition in which the lining of the esophagus changes to resemble the lining of the stomach, increasing the risk of esophageal cancer. It is a significant pathological finding in the upper gastrointestinal tract.",
+    "upper-gi-tract/pathological-findings/barretts-short-segment": "Barrett's esophagus with a short segment refers to a limited area of the esophagus where the lining has changed to resemble the stomach lining. This condition increases the risk of developing esophageal cancer.",
+    "upper-gi-tract/pathological-findings/esophagitis-a": "Esophagitis Grade A indicates mild inflammation of the esophagus, often due to acid reflux. It is characterized by small, isolated areas of erosion in the lining of the esophagus.",
+    "upper-gi-tract/pathological-findings/esophagitis-b-d": "Esophagitis Grades B-D represent progressively severe inflammation and damage to the esophagus lining, often due to acid reflux, with Grade D being the most severe, involving extensive erosion."
+}
+
+class DescriptionIndex:
+    """
+    Read-only label -> description mapping with optional description embeddings.
+    """
+
+    def __init__(self, descriptions, embeddings=None, labels=None):
+        """
+        :param descriptions: Dictionary of label name to description.
+        :param embeddings: Optional dictionary of label name to embedding vector.
+        :param labels: Label names in label index order, the keys of descriptions by default.
+        """
+        self.labels = tuple(descriptions if labels is None else labels)
+        self.descriptions = MappingProxyType(dict(descriptions))
+        self.embeddings = MappingProxyType(dict(embeddings or {}))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get(self, label, default=DEFAULT_DESCRIPTION):
+        return self.descriptions.get(label, default)
+
+    def get_many(self, labels, default=DEFAULT_DESCRIPTION):
+        """
+        :return: Dictionary of every label in labels to its description.
+        """
+        return {label: self.descriptions.get(label, default) for label in labels}
+
+    def for_indices(self, indices, default=DEFAULT_DESCRIPTION):
+        """
+        :return: List with the description of every label index, default for unknown ones.
+        """
+        return [self.descriptions.get(self.labels[index], default) if 0 <= index < len(self.labels) else default
+                for index in indices]
+
+    def embedding(self, label):
+        """
+        :return: The precomputed embedding of a label's description, or None.
+        """
+        return self.embeddings.get(label)
+
+def read_descriptions_csv(csv_path):
+    """
+    :return: Dictionary of label to description, empty if the file does not exist.
+    """
+    try:
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            return {row['Label']: row['Description'] for row in csv.DictReader(f)
+                    if row.get('Label') and row.get('Description')}
+    except FileNotFoundError:
+        return {}
+
+def read_embeddings(embeddings_path):
+    """
+    :return: Dictionary of label to embedding vector, empty if the file does not exist.
+    """
+    if not os.path.exists(embeddings_path):
+        return {}
+    import numpy as np
+    with np.load(embeddings_path) as data:
+        return {str(label): vector for label, vector in zip(data['labels'], data['embeddings'])}
+
+def build_index(csv_path=DESCRIPTIONS_CSV, embeddings_path=DESCRIPTION_EMBEDDINGS):
+    """
+    Build a DescriptionIndex from the CSV and embeddings files, falling back to the built-in descriptions.
+    """
+    # utils imports this module, and label indices are defined there rather than by the file order
+    from utils import index_to_class
+
+    descriptions = dict(_BUILTIN_DESCRIPTIONS)
+    descriptions.update(read_descriptions_csv(csv_path))
+    labels = [index_to_class[index] for index in sorted(index_to_class)]
+    return DescriptionIndex(descriptions, read_embeddings(embeddings_path), labels)
+
+@functools.lru_cache(maxsize=None)
+def description_index():
+    """
+    :return: The DescriptionIndex of this process, built on first use.
+    """
+    return build_index()
+
+def embed_descriptions(model_path, output_path=DESCRIPTION_EMBEDDINGS, batch_size=8):
+    """
+    Compute the mean-pooled BERT embedding of every description and save them for build_index.
+    """
+    import numpy as np
+    import torch
+    from transformers import BertModel, BertTokenizer
+
+    index = build_index(embeddings_path='')
+    tokenizer = BertTokenizer.from_pretrained(model_path)
+    model = BertModel.from_pretrained(model_path).eval()
+
+    vectors = []
+    with torch.no_grad():
+        for start in range(0, len(index.labels), batch_size):
+            texts = [index.get(label) for label in index.labels[start:start + batch_size]]
+            inputs = tokenizer(texts, return_tensors='pt', truncation=True, padding=True)
+            hidden = model(**inputs).last_hidden_state
+            mask = inputs['attention_mask'].unsqueeze(-1)
+            vectors.append(((hidden * mask).sum(dim=1) / mask.sum(dim=1)).numpy())
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    np.savez(output_path, labels=np.array(index.labels), embeddings=np.concatenate(vectors).astype(np.float32))
+    print(f"Saved {len(index.labels)} description embeddings to {output_path}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect the label descriptions or precompute their embeddings.")
+    parser.add_argument('--embed', metavar='MODEL_PATH',
+                        help="Fine-tuned BERT directory to embed the descriptions with.")
+    parser.add_argument('--output', default=DESCRIPTION_EMBEDDINGS)
+    args = parser.parse_args()
+
+    if args.embed:
+        embed_descriptions(args.embed, args.output)
+    else:
+        index = description_index()
+        for label in index.labels:
+            print(f"{label}: {index.get(label)}")
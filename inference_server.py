@@ -0,0 +1,276 @@
+"""
+Dynamic batching of inference requests from concurrent jobs.
+
+BatchingInferenceServer holds one model in a background thread and merges the batches that
+concurrent callers submit into larger forward passes, waiting at most max_latency seconds for a
+batch to fill up. It can be used in-process, by the tasks of a threaded worker, or behind a Unix
+socket as a sidecar shared by every worker process on the machine:
+
+    python inference_server.py --socket /tmp/video-summary-inference.sock
+
+Workers then use RemoteModel instead of loading their own copy of the weights, see
+INFERENCE_SERVER in tasks.py.
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+import torch
+from metrics import registry, BATCH_SIZE_BUCKETS
+from utils import run_model
+
+# Message framing on the socket: one kind byte and the payload length
+HEADER = struct.Struct('!cQ')
+INFER, STATS, RESULT, ERROR, JSON = b'I', b'S', b'R', b'E', b'J'
+
+# Seconds between two metric flushes of the sidecar
+METRICS_FLUSH_INTERVAL = 5.0
+
+class BatchingInferenceServer:
+    """
+    Run a model in a background thread over batches merged from concurrent submit calls.
+
+    A batch is run as soon as it holds max_batch_size frames, or max_latency seconds after its
+    first request arrived. Requests are never split, one larger than max_batch_size runs alone, and
+    only requests of the same input size share a batch.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_latency=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._requests = queue.Queue()
+        # Request that did not fit in the previous batch, only touched by the serving thread
+        self._carry = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.frames = 0
+        self.busy_seconds = 0.0
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._serve, name='inference-server', daemon=True)
+        self._thread.start()
+
+    def submit(self, images):
+        """
+        Queue a batch of preprocessed frames.
+
+        :param images: Tensor of shape (N, 3, height, width).
+        :return: Future resolving to the (N, num_classes) logits.
+        """
+        future = Future()
+        self._requests.put((images, future))
+        return future
+
+    def __call__(self, images):
+        # Lets the server stand in for a model anywhere run_model is used
+        return self.submit(images).result()
+
+    def eval(self):
+        return self
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        # Block for the first request, then gather more until the batch is full or the deadline passes
+        first, self._carry = self._carry or self._requests.get(), None
+        if first is None:
+            return None
+        pending = [first]
+        size = len(first[0])
+        deadline = time.perf_counter() + self.max_latency
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None)
+                break
+            if size + len(request[0]) > self.max_batch_size or request[0].shape[1:] != first[0].shape[1:]:
+                # Keep the batch within bounds and of one input size (the cascade sends two), the
+                # request opens the next one
+                self._carry = request
+                break
+            pending.append(request)
+            size += len(request[0])
+        return pending
+
+    def _serve(self):
+        while True:
+            pending = self._collect()
+            if pending is None:
+                return
+            started = time.perf_counter()
+            try:
+                with registry.timer('server_inference_seconds'):
+                    logits = run_model(self.model, torch.cat([images for images, _ in pending]))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for images, future in pending:
+                future.set_result(logits[offset:offset + len(images)])
+                offset += len(images)
+
+            registry.observe('server_batch_size', offset, BATCH_SIZE_BUCKETS)
+            with self._lock:
+                self.batches += 1
+                self.frames += offset
+                self.busy_seconds += time.perf_counter() - started
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                'batches': self.batches,
+                'frames': self.frames,
+                'mean_batch_size': self.frames / self.batches if self.batches else 0.0,
+                'frames_per_sec': self.frames / self.busy_seconds if self.busy_seconds else 0.0,
+                'utilization': self.busy_seconds / elapsed if elapsed else 0.0,
+                'max_batch_size': self.max_batch_size,
+                'max_latency': self.max_latency,
+            }
+
+def _encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def _decode_array(payload):
+    return np.load(io.BytesIO(payload), allow_pickle=False)
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Inference server closed the connection")
+        data.extend(chunk)
+    return bytes(data)
+
+def send_message(sock, kind, payload=b''):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+def recv_message(sock):
+    kind, size = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return kind, _recv_exactly(sock, size)
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    # One thread per connected worker, all of them feeding the same batching server
+    def handle(self):
+        batcher = self.server.batcher
+        while True:
+            try:
+                kind, payload = recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                if kind == INFER:
+                    logits = batcher.submit(torch.from_numpy(_decode_array(payload))).result()
+                    send_message(self.request, RESULT, _encode_array(logits.numpy()))
+                elif kind == STATS:
+                    send_message(self.request, JSON, json.dumps(batcher.stats()).encode())
+                else:
+                    send_message(self.request, ERROR, f"Unknown message kind {kind!r}".encode())
+            except Exception as e:
+                send_message(self.request, ERROR, str(e).encode())
+
+class InferenceSidecar(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super(InferenceSidecar, self).__init__(socket_path, _RequestHandler)
+        self.batcher = batcher
+
+class RemoteModel:
+    """
+    Callable stand-in for a model that sends batches to an InferenceSidecar.
+
+    Every thread keeps its own connection, so concurrent tasks of a worker do not wait on each other.
+    """
+
+    def __init__(self, socket_path, timeout=300):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _request(self, kind, payload=b''):
+        sock = self._connection()
+        try:
+            send_message(sock, kind, payload)
+            reply_kind, reply = recv_message(sock)
+        except (OSError, ConnectionError):
+            # Reconnect on the next call, the sidecar may have been restarted
+            sock.close()
+            self._local.sock = None
+            raise
+        if reply_kind == ERROR:
+            raise RuntimeError(f"Inference server error: {reply.decode()}")
+        return reply
+
+    def __call__(self, images):
+        return torch.from_numpy(_decode_array(self._request(INFER, _encode_array(images.numpy()))))
+
+    def eval(self):
+        return self
+
+    def stats(self):
+        return json.loads(self._request(STATS))
+
+def _flush_metrics_periodically(interval=METRICS_FLUSH_INTERVAL):
+    while True:
+        time.sleep(interval)
+        registry.flush()
+
+if __name__ == '__main__':
+    from backends import build_backend
+    from celery_app import INFERENCE_BACKEND, result_cache
+    from model import load_combined_model
+    from pipeline import configure_threads
+
+    parser = argparse.ArgumentParser(description="Serve the model to every worker of this machine over a Unix socket.")
+    parser.add_argument('--socket', default=os.environ.get('INFERENCE_SOCKET', '/tmp/video-summary-inference.sock'))
+    parser.add_argument('--max-batch-size', type=int, default=int(os.environ.get('SERVER_MAX_BATCH_SIZE', 32)))
+    parser.add_argument('--max-latency', type=float, default=float(os.environ.get('SERVER_MAX_LATENCY', 0.01)),
+                        help="Seconds a batch may wait for more frames.")
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help="torch intra-op threads.")
+    args = parser.parse_args()
+
+    configure_threads(args.threads)
+    model = load_combined_model(num_classes=23)
+    # Workers using this server key their results by the weights it loaded
+    result_cache.invalidate_weights(model.weights_sha256)
+    model = build_backend(model, INFERENCE_BACKEND)
+    server = InferenceSidecar(args.socket, BatchingInferenceServer(model, args.max_batch_size, args.max_latency))
+    threading.Thread(target=_flush_metrics_periodically, daemon=True).start()
+    print(f"Serving {INFERENCE_BACKEND} inference on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
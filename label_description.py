@@ -1,66 +1,22 @@
-# utils.py
+from descriptions import description_index, build_index
 
-import pandas as pd
-import torch
-from transformers import BertTokenizer, BertForSequenceClassification
+# Load the labels and descriptions, see descriptions.py for the file format
+def load_label_mapping(csv_file_path="label_description.csv"):
+    return build_index(csv_file_path).descriptions
 
-# Existing code...
-# Define the class-to-index mapping
-class_to_index = {
-    'lower-gi-tract/anatomical-landmarks/cecum': 0,
-    'lower-gi-tract/anatomical-landmarks/ileum': 1,
-    'lower-gi-tract/anatomical-landmarks/retroflex-rectum': 2,
-    'lower-gi-tract/pathological-findings/hemorrhoids': 3,
-    'lower-gi-tract/pathological-findings/polyps': 4,
-    'lower-gi-tract/pathological-findings/ulcerative-colitis-grade-0-1': 5,
-    'lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1': 6,
-    'lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1-2': 7,
-    'lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2': 8,
-    'lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2-3': 9,
-    'lower-gi-tract/pathological-findings/ulcerative-colitis-grade-3': 10,
-    'lower-gi-tract/quality-of-mucosal-views/bbps-0-1': 11,
-    'lower-gi-tract/quality-of-mucosal-views/bbps-2-3': 12,
-    'lower-gi-tract/quality-of-mucosal-views/impacted-stool': 13,
-    'lower-gi-tract/therapeutic-interventions/dyed-lifted-polyps': 14,
-    'lower-gi-tract/therapeutic-interventions/dyed-resection-margins': 15,
-    'upper-gi-tract/anatomical-landmarks/pylorus': 16,
-    'upper-gi-tract/anatomical-landmarks/retroflex-stomach': 17,
-    'upper-gi-tract/anatomical-landmarks/z-line': 18,
-    'upper-gi-tract/pathological-findings/barretts': 19,
-    'upper-gi-tract/pathological-findings/barretts-short-segment': 20,
-    'upper-gi-tract/pathological-findings/esophagitis-a': 21,
-    'upper-gi-tract/pathological-findings/esophagitis-b-d': 22
-}
+# Load the fine-tuned BERT model and tokenizer, only needed to precompute description embeddings
+def load_bert_model(model_path="fine_tuned_biobert-20240907T082926Z-001", tokenizer_path=None):
+    from transformers import BertTokenizer, BertForSequenceClassification
 
-# Reverse the dictionary to map indexes to class names
-index_to_class = {index: cls for cls, index in class_to_index.items()}
-
-# Load the CSV file containing labels and descriptions
-def load_label_mapping(csv_file_path):
-    df = pd.read_csv("label_description.csv")
-    return {row['Label']: row['Description'] for _, row in df.iterrows()}
-
-# Load the fine-tuned BERT model and tokenizer
-def load_bert_model(model_path, tokenizer_path):
-    model = BertForSequenceClassification.from_pretrained("fine_tuned_biobert-20240907T082926Z-001")
-    tokenizer = BertTokenizer.from_pretrained("fine_tuned_biobert-20240907T082926Z-001")
+    model = BertForSequenceClassification.from_pretrained(model_path)
+    tokenizer = BertTokenizer.from_pretrained(tokenizer_path or model_path)
     return model, tokenizer
 
-# Get description for a given label
-def get_label_description(label, model, tokenizer, label_mapping):
-    label_str = index_to_class.get(label, "Unknown Label")
-    
-    inputs = tokenizer(label_str, return_tensors="pt", truncation=True, padding=True)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-
-    with torch.no_grad():
-        outputs = model(**inputs)
-        logits = outputs.logits
-        predicted_label = torch.argmax(logits, dim=1).item()
-
-    description = label_mapping.get(label_str, "Description not found")
-    return description
-
-# Update existing functions if needed
+# Get description for a given label index. The model and tokenizer are no longer used: the
+# description is a lookup in the precomputed index
+def get_label_description(label, model=None, tokenizer=None, label_mapping=None):
+    index = description_index()
+    if label_mapping is None:
+        return index.for_indices([label], "Description not found")[0]
+    label_str = index.labels[label] if 0 <= label < len(index.labels) else "Unknown Label"
+    return label_mapping.get(label_str, "Description not found")
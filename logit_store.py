@@ -0,0 +1,155 @@
+import json
+import os
+import numpy as np
+from aggregate import run_lengths, summarize_labels
+
+# Files a job keeps in its workspace so its results can be re-aggregated without the model:
+# float16 logits (frames x classes), the frame index of every row and the video fps
+LOGITS_FILE = 'logits.npy'
+LOGIT_FRAMES_FILE = 'logit_frames.npy'
+LOGITS_META_FILE = 'logits.json'
+LOGIT_FILES = (LOGITS_FILE, LOGIT_FRAMES_FILE, LOGITS_META_FILE)
+
+SMOOTHING_MODES = ('none', 'majority', 'median')
+# Largest smoothing window in frames
+MAX_SMOOTHING_WINDOW = int(os.environ.get('MAX_SMOOTHING_WINDOW', 301))
+# The median filter copies frames x classes x window values, it works on blocks of this many
+# frames so that a long video does not need all of them at once
+MEDIAN_BLOCK_FRAMES = 1024
+
+def _part_prefix(part):
+    return '' if part is None else f'part{part:06d}.'
+
+def save_logits(workspace, frame_indices, logits, fps=None, part=None):
+    """
+    Write the per-frame logits of a job, or of one chunk of it, as float16 .npy files.
+
+    :param frame_indices: Sorted numpy array with the frame index of every row.
+    :param logits: Numpy array of shape (frames, classes).
+    :param part: First sample of the chunk, None for a complete video. Parts are combined by
+                 merge_logit_parts once every chunk is done.
+    """
+    prefix = _part_prefix(part)
+    stored = np.lib.format.open_memmap(os.path.join(workspace, prefix + LOGITS_FILE), mode='w+',
+                                       dtype=np.float16, shape=np.shape(logits))
+    stored[:] = logits
+    stored.flush()
+    del stored
+    np.save(os.path.join(workspace, prefix + LOGIT_FRAMES_FILE), np.asarray(frame_indices, dtype=np.int64))
+    if part is None:
+        with open(os.path.join(workspace, LOGITS_META_FILE), 'w') as f:
+            json.dump({'fps': fps, 'frames': len(frame_indices), 'classes': int(np.shape(logits)[1])}, f)
+
+def merge_logit_parts(workspace, fps):
+    """
+    Concatenate the logits saved by every chunk of a job, in video order, into a single file.
+    """
+    parts = sorted(name[:-len(LOGITS_FILE)] for name in os.listdir(workspace)
+                   if name.startswith('part') and name.endswith('.' + LOGITS_FILE))
+    if not parts:
+        return
+    frame_indices = np.concatenate([np.load(os.path.join(workspace, prefix + LOGIT_FRAMES_FILE)) for prefix in parts])
+    logits = np.concatenate([np.load(os.path.join(workspace, prefix + LOGITS_FILE)) for prefix in parts])
+    save_logits(workspace, frame_indices, logits, fps)
+    for prefix in parts:
+        for name in (LOGITS_FILE, LOGIT_FRAMES_FILE):
+            os.remove(os.path.join(workspace, prefix + name))
+
+def load_logits(workspace):
+    """
+    Memory-map the logits of a job.
+
+    :return: Tuple (frame_indices, logits, meta), logits being a read-only float16 memmap.
+    :raises FileNotFoundError: If the job did not store its logits.
+    """
+    with open(os.path.join(workspace, LOGITS_META_FILE)) as f:
+        meta = json.load(f)
+    frame_indices = np.load(os.path.join(workspace, LOGIT_FRAMES_FILE))
+    logits = np.load(os.path.join(workspace, LOGITS_FILE), mmap_mode='r')
+    return frame_indices, logits, meta
+
+def softmax(logits):
+    logits = np.asarray(logits, dtype=np.float32)
+    exponentials = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+def _windows(values, window):
+    # Centered sliding windows along the first axis, edges padded with the nearest value
+    half = window // 2
+    padded = np.concatenate([np.repeat(values[:1], half, axis=0), values,
+                             np.repeat(values[-1:], window - 1 - half, axis=0)])
+    return np.lib.stride_tricks.sliding_window_view(padded, window, axis=0)
+
+def majority_smooth(labels, window, num_classes):
+    """
+    Replace every label by the most frequent one in a centered window.
+    """
+    if window <= 1 or labels.size == 0:
+        return labels
+    votes = np.eye(num_classes, dtype=np.int32)[labels]
+    return _windows(votes, window).sum(axis=-1).argmax(axis=1)
+
+def median_smooth(probabilities, window):
+    """
+    Replace every class probability by its median over a centered window.
+    """
+    if window <= 1 or len(probabilities) == 0:
+        return probabilities
+    windows = _windows(probabilities, window)
+    smoothed = np.empty(probabilities.shape, dtype=probabilities.dtype)
+    for start in range(0, len(windows), MEDIAN_BLOCK_FRAMES):
+        smoothed[start:start + MEDIAN_BLOCK_FRAMES] = np.median(windows[start:start + MEDIAN_BLOCK_FRAMES], axis=-1)
+    return smoothed
+
+def merge_short_segments(frame_indices, labels, fps, min_segment_seconds):
+    """
+    Relabel segments shorter than min_segment_seconds with the label of the previous long enough
+    segment, or of the next one at the start of the video.
+    """
+    if min_segment_seconds <= 0 or labels.size == 0:
+        return labels
+    runs = run_lengths(frame_indices, labels)
+    durations = (runs['end_frames'] - runs['start_frames'] + 1) / fps
+    kept = durations >= min_segment_seconds
+    if kept.all() or not kept.any():
+        return labels
+
+    run_positions = np.arange(len(kept))
+    previous = np.maximum.accumulate(np.where(kept, run_positions, -1))
+    following = np.minimum.accumulate(np.where(kept, run_positions, len(kept))[::-1])[::-1]
+    source = np.where(previous >= 0, previous, following)
+
+    run_lengths_in_frames = np.diff(np.append(np.searchsorted(frame_indices, runs['start_frames']), len(labels)))
+    return np.repeat(runs['labels'][source], run_lengths_in_frames)
+
+def reaggregate(frame_indices, logits, fps, smoothing='none', window=1, confidence_floor=0.0, min_segment_seconds=0.0):
+    """
+    Rebuild segments and label counts from stored logits with different post-processing.
+
+    Frames whose top probability is below confidence_floor are left out, so the segment before
+    them extends over them.
+
+    :param smoothing: One of SMOOTHING_MODES: majority vote over the predicted labels or median
+                      of the class probabilities, over a centered window of `window` frames.
+    :return: Tuple (segments, label_occurrences) as returned by summarize_labels.
+    :raises ValueError: If window is larger than MAX_SMOOTHING_WINDOW.
+    """
+    if smoothing not in SMOOTHING_MODES:
+        raise ValueError(f"Unknown smoothing '{smoothing}', expected one of {', '.join(SMOOTHING_MODES)}")
+    if window > MAX_SMOOTHING_WINDOW:
+        raise ValueError(f"window must be at most {MAX_SMOOTHING_WINDOW} frames")
+    # A window spanning the whole video already smooths over every frame
+    window = min(window, len(logits))
+    probabilities = softmax(logits)
+    if smoothing == 'median':
+        probabilities = median_smooth(probabilities, window)
+    labels = probabilities.argmax(axis=1)
+    if smoothing == 'majority':
+        labels = majority_smooth(labels, window, probabilities.shape[1])
+
+    confident = probabilities.max(axis=1) >= confidence_floor
+    frame_indices, labels = np.asarray(frame_indices)[confident], labels[confident]
+    labels = merge_short_segments(frame_indices, labels, fps, min_segment_seconds)
+
+    segments, label_occurrences, _ = summarize_labels(frame_indices, labels, fps)
+    return segments, label_occurrences
@@ -0,0 +1,208 @@
+import bisect
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Every process flushes its metrics to <METRICS_DIR>/<host>-<pid>.json, /metrics merges all of them
+# so that the web process can report what the Celery workers measured. The files of processes that
+# exited are folded into <host>-exited.json, so that their counts survive and pids can be reused
+METRICS_DIR = os.environ.get('METRICS_DIR', 'cache/metrics/')
+
+# Prefix of every exported metric name
+METRICS_NAMESPACE = 'video_summary'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Help text of the metrics recorded by the app, others are exported without one
+DESCRIPTIONS = {
+    'decode_seconds': "Time spent decoding the frames of a video.",
+    'preprocess_seconds': "Time spent preprocessing one batch of frames.",
+    'inference_seconds': "Time spent in one forward pass of the model.",
+    'aggregation_seconds': "Time spent turning predictions into segments, counts and example images.",
+    'queue_wait_seconds': "Time between an upload and the start of its processing.",
+    'task_seconds': "Total processing time of a video.",
+    'model_load_seconds': "Time spent loading the model in a worker process.",
+    'batch_size': "Number of frames per forward pass.",
+    'server_inference_seconds': "Time spent in one forward pass of the batching inference server.",
+    'server_batch_size': "Number of frames, merged from concurrent jobs, per forward pass of the inference server.",
+    'frames_decoded_total': "Frames sampled from videos.",
+    'frames_inferred_total': "Frames sent through the model.",
+    'frames_escalated_total': "Frames the inference cascade sent through the full-resolution pass.",
+    'videos_processed_total': "Videos processed.",
+    'uploads_total': "Videos uploaded.",
+    'uploads_deduplicated_total': "Chunked uploads skipped because the same video was stored before.",
+    'uploads_started_early_total': "Chunked uploads processed while still arriving.",
+    'result_cache_hits_total': "Uploads answered from the result cache.",
+}
+
+class Registry:
+    """
+    Thread-safe in-process store of counters and histograms.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {'buckets': list(buckets), 'counts': [0] * len(buckets),
+                                                     'sum': 0.0, 'count': 0}
+            position = bisect.bisect_left(histogram['buckets'], value)
+            if position < len(histogram['counts']):
+                histogram['counts'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps({'counters': self.counters, 'histograms': self.histograms}))
+
+    def flush(self, directory=METRICS_DIR):
+        """
+        Write this process' metrics where the /metrics route of any process can read them.
+        """
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, os.path.join(directory, _process_file(os.getpid())))
+
+# Registry of the current process
+registry = Registry()
+
+def _process_file(pid):
+    # Host names tell apart the processes of containers sharing the directory
+    return f'{socket.gethostname()}-{pid}.json'
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _merge(snapshots):
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.get('counters', {}).items():
+            counters[name] = counters.get(name, 0) + value
+        for name, histogram in snapshot.get('histograms', {}).items():
+            merged = histograms.get(name)
+            if merged is None or merged['buckets'] != histogram['buckets']:
+                histograms[name] = merged = {'buckets': histogram['buckets'], 'counts': [0] * len(histogram['buckets']),
+                                             'sum': 0.0, 'count': 0}
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+    return counters, histograms
+
+def collect(directory=METRICS_DIR):
+    """
+    Merge the flushed metrics of every process with the live metrics of this one.
+    """
+    snapshots = [registry.snapshot()]
+    own_file = _process_file(os.getpid())
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if name.endswith('.json') and name != own_file:
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+    return _merge(snapshots)
+
+def prune_exited(directory=METRICS_DIR):
+    """
+    Fold the metrics files of the processes of this host that exited into <host>-exited.json.
+
+    :return: Number of files removed.
+    """
+    host = socket.gethostname()
+    exited_path = os.path.join(directory, f'{host}-exited.json')
+    try:
+        lock = open(os.path.join(directory, f'{host}-exited.lock'), 'w')
+    except FileNotFoundError:
+        return 0
+    with lock:
+        # Two processes folding the same file would count it twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        paths = []
+        for name in os.listdir(directory):
+            prefix, _, pid = name[:-len('.json')].rpartition('-')
+            if (name.endswith('.json') and prefix == host and pid.isdigit() and int(pid) != os.getpid()
+                    and not _is_running(int(pid))):
+                paths.append(os.path.join(directory, name))
+        if not paths:
+            return 0
+
+        snapshots = []
+        for path in [exited_path] + paths:
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        counters, histograms = _merge(snapshots)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'counters': counters, 'histograms': histograms}, f)
+        os.replace(temp_path, exited_path)
+        for path in paths:
+            os.remove(path)
+    return len(paths)
+
+def render_prometheus(directory=METRICS_DIR):
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    prune_exited(directory)
+    counters, histograms = collect(directory)
+    lines = []
+    for name, value in sorted(counters.items()):
+        full_name = f'{METRICS_NAMESPACE}_{name}'
+        if name in DESCRIPTIONS:
+            lines.append(f'# HELP {full_name} {DESCRIPTIONS[name]}')
+        lines.append(f'# TYPE {full_name} counter')
+        lines.append(f'{full_name} {value}')
+    for name, histogram in sorted(histograms.items()):
+        full_name = f'{METRICS_NAMESPACE}_{name}'
+        if name in DESCRIPTIONS:
+            lines.append(f'# HELP {full_name} {DESCRIPTIONS[name]}')
+        lines.append(f'# TYPE {full_name} histogram')
+        cumulative = 0
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            cumulative += count
+            lines.append(f'{full_name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{full_name}_bucket{{le="+Inf"}} {histogram["count"]}')
+        lines.append(f'{full_name}_sum {histogram["sum"]}')
+        lines.append(f'{full_name}_count {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,8 @@
+import time
 import torch
 from torch import nn
 from torchvision.models import resnet50, densenet121
-import gdown
+from weights import fetch_weights
 
 class CombinedModel(nn.Module):
     def __init__(self, num_classes):
@@ -22,13 +23,30 @@ class CombinedModel(nn.Module):
         x = self.fc2(x)
         return x
 
-def load_combined_model(num_classes):
-    gdown.download('https://drive.google.com/uc?id=1pmZf86M8ixCAvNXanKnNTjumQGSjC8NO', 'combined5.pth', quiet=False)
+def load_combined_model(num_classes, weights_path=None):
+    """
+    Build a CombinedModel and load the trained weights.
+
+    :param num_classes: Number of output classes.
+    :param weights_path: Optional local weights file, the weight cache is used when omitted.
+    :return: The model in evaluation mode, with the digest of its weights in `weights_sha256`.
+    """
+    started = time.perf_counter()
+    if weights_path is None:
+        weights_path, digest = fetch_weights()
+    else:
+        digest = None
+    fetched = time.perf_counter()
+
     model = CombinedModel(num_classes=num_classes)
-    model.load_state_dict(torch.load('combined5.pth', map_location=torch.device('cpu')))
+    model.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu')))
     model.eval()
+    model.weights_sha256 = digest
+
+    print(f"Loaded model in {time.perf_counter() - started:.2f}s "
+          f"(weights {fetched - started:.2f}s, build {time.perf_counter() - fetched:.2f}s)")
     return model
 
-# Example usage
-model = load_combined_model(num_classes=23)  # Adjust num_classes as needed
-print(model)
+if __name__ == '__main__':
+    # Example usage
+    print(load_combined_model(num_classes=23))
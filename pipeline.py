@@ -0,0 +1,482 @@
+import math
+import queue
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+from torchvision import transforms
+from adaptive import AdaptiveSampler
+from aggregate import summarize_labels
+from logit_store import save_logits, merge_logit_parts
+from backends import build_backend, CascadeModule
+from model import load_combined_model
+from metrics import registry, BATCH_SIZE_BUCKETS
+from utils import iter_frames, save_frame, batched, run_model, decode_logits, sampling_step, index_to_class
+
+# Side of the square model input
+INPUT_SIZE = 224
+
+# Define the transformation for images, preprocess_batch does the same on numpy frames without PIL
+transform = transforms.Compose([
+    transforms.Resize((INPUT_SIZE, INPUT_SIZE)),  # Adjust size if necessary
+    transforms.ToTensor(),
+])
+
+# Label of a sampled frame that has no prediction yet, and of one whose batch failed
+PENDING_LABEL = -2
+FAILED_LABEL = -3
+
+# Decode statistics that are summed when chunks are merged
+ADDITIVE_STATS = ('frames_read', 'frames_sampled', 'decode_seconds', 'frames_inferred', 'frames_reused',
+                  'scene_changes', 'cascade_frames', 'cascade_escalated', 'cascade_audited', 'cascade_audit_agreed')
+
+def configure_threads(torch_threads, interop_threads=1, opencv_threads=1):
+    """
+    Set the thread pools of the current process.
+
+    Inference gets torch_threads intra-op threads. Inter-op parallelism is not used by the models,
+    and OpenCV calls already run on several pipeline threads at once, so both default to a single
+    thread to keep the process from oversubscribing its cores.
+    """
+    torch.set_num_threads(torch_threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # Only possible once, before any inter-op work has started in this process
+        pass
+    cv2.setNumThreads(opencv_threads)
+
+def preprocess_batch(frames, size=INPUT_SIZE):
+    """
+    Resize RGB numpy frames and stack them into a float input batch scaled to [0, 1], like transform.
+
+    Frames are shrunk with area interpolation, which is close to the antialiased resize of PIL;
+    `python backends.py <video> --check-preprocessing` measures how close. Bump
+    utils.PREPROCESSING_VERSION when this changes.
+
+    :return: Tensor of shape (len(frames), 3, size, size).
+    """
+    batch = np.empty((len(frames), size, size, 3), dtype=np.uint8)
+    for position, frame in enumerate(frames):
+        shrinking = frame.shape[0] >= size and frame.shape[1] >= size
+        cv2.resize(frame, (size, size), dst=batch[position],
+                   interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+    return torch.from_numpy(batch).permute(0, 3, 1, 2).float().div_(255).contiguous()
+
+def _preprocess_timed(batch):
+    with registry.timer('preprocess_seconds'):
+        return preprocess_batch([frame for _, _, frame in batch])
+
+def iter_preprocessed(frames, batch_size, threads=2, depth=2):
+    """
+    Overlap decoding, preprocessing and the consumer (inference).
+
+    A decoder thread pulls frames and hands each batch to a pool of `threads` preprocessing threads.
+    At most `depth` batches wait for the consumer, so decoding stops when inference falls behind.
+    With threads=0 everything runs in the calling thread.
+
+    :param frames: Iterable of (key, timestamp, frame) tuples such as iter_frames.
+    :return: Generator of (batch, images) pairs in decode order, images being the input tensor or
+             the exception raised while preprocessing that batch.
+    """
+    if threads <= 0:
+        for batch in batched(frames, batch_size):
+            try:
+                yield batch, _preprocess_timed(batch)
+            except Exception as e:
+                yield batch, e
+        return
+
+    ready = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up when the consumer is gone instead of blocking forever
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decode(pool):
+        try:
+            for batch in batched(frames, batch_size):
+                if not put((batch, pool.submit(_preprocess_timed, batch))):
+                    break
+        except Exception as e:
+            put((None, e))
+        finally:
+            if hasattr(frames, 'close'):
+                frames.close()
+            put((None, done))
+
+    with ThreadPoolExecutor(threads, thread_name_prefix='preprocess') as pool:
+        decoder = threading.Thread(target=decode, args=(pool,), name='decoder', daemon=True)
+        decoder.start()
+        try:
+            while True:
+                batch, pending = ready.get()
+                if batch is None:
+                    if pending is done:
+                        break
+                    raise pending
+                try:
+                    yield batch, pending.result()
+                except Exception as e:
+                    yield batch, e
+        finally:
+            stop.set()
+            decoder.join()
+
+class SegmentTracker:
+    """
+    Build the segments of group_consecutive_frames incrementally, from label indices in frame order.
+    """
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.current = None
+        # Number of decoded frames already fed in, see analyze_video
+        self.position = 0
+
+    def add(self, frame_index, label):
+        """
+        :return: The segment closed by this frame, or None.
+        """
+        if self.current is not None and self.current['label'] == label:
+            self.current['end_frame'] = frame_index
+            return None
+        closed = self.finish(frame_index - 1)
+        self.current = {'label': label, 'start_frame': frame_index, 'end_frame': frame_index}
+        return closed
+
+    def finish(self, end_frame=None):
+        """
+        Close the open segment, at end_frame or at its last frame.
+        """
+        if self.current is None:
+            return None
+        segment, self.current = self.current, None
+        if end_frame is not None:
+            segment['end_frame'] = end_frame
+        return {'label': index_to_class.get(segment['label'], 'Unknown'),
+                'start_time': segment['start_frame'] / self.fps,
+                'end_time': segment['end_frame'] / self.fps,
+                'start_frame': segment['start_frame'],
+                'end_frame': segment['end_frame']}
+
+def analyze_video(model, video_path, frame_rate=1, sampling_mode='grab', similarity_threshold=-1,
+                  batch_size=16, sample_range=None, on_progress=None, preprocess_threads=2, queue_depth=2,
+                  follow=None):
+    """
+    Run the model over the sampled frames of a video, or of one chunk of it.
+
+    :param model: Model or inference backend to run.
+    :param video_path: Path to the video file.
+    :param frame_rate: Number of frames to sample per second of video.
+    :param sampling_mode: One of utils.SAMPLING_MODES.
+    :param similarity_threshold: Adaptive sampling threshold in bits, negative to disable it.
+    :param batch_size: Number of frames per forward pass.
+    :param sample_range: Optional (first, last) range of samples to process, see iter_frames.
+    :param on_progress: Optional callable invoked after every batch with the decode and inference
+                        counters so far and the list of segments closed by that batch.
+    :param preprocess_threads: Threads resizing frames while the model runs, 0 to decode, preprocess
+                               and infer one after another in the calling thread.
+    :param queue_depth: Number of preprocessed batches that may wait for the model.
+    :param follow: Optional callable returning the (path, complete) pair of a video that is still
+                   being uploaded, processed as it arrives, see iter_frames.
+    :return: Tuple (predictions, example_frames, stats) where predictions is a (frame_indices, labels,
+             logits) tuple of numpy arrays holding the int8 label index and float16 logits of every
+             sampled frame in frame order, and example_frames maps each label index to the
+             (frame_index, frame) of its first frame.
+    """
+    started = time.perf_counter()
+    decode_stats = {}
+    # Counters of this call only, the cascade may be shared with concurrent calls
+    cascade = model.session() if isinstance(model, CascadeModule) else None
+    if cascade is not None:
+        model = cascade
+    sampler = AdaptiveSampler(similarity_threshold) if similarity_threshold >= 0 else None
+    time_to_first_result = None
+
+    # One entry per decoded frame, in decode order, which is frame order
+    frame_indices = array('q')
+    labels = array('b')
+    # Logits of every batch with the decode positions of its frames
+    logit_batches = []
+
+    # To store the first frame for each label, kept in memory until the end
+    example_frames = {}
+
+    # Perform prediction on batches of decoded frames, straight from the decoder, skipping the ones
+    # the adaptive sampler considers redundant. Frames are numbered by decode position from here on,
+    # so the sampler's reused map points straight into the label array
+    frames = _number_frames(iter_frames(video_path, frame_rate, sampling_mode, decode_stats, sample_range, follow),
+                            frame_indices, labels)
+    if sampler is not None:
+        frames = sampler.filter(frames)
+    tracker = None
+    frames_inferred = 0
+    for batch, images in iter_preprocessed(frames, batch_size, preprocess_threads, queue_depth):
+        try:
+            if isinstance(images, Exception):
+                raise images
+            with registry.timer('inference_seconds'):
+                output = run_model(model, images)
+            indices, _ = decode_logits(output)
+        except Exception as e:
+            print(f"Error processing frames {frame_indices[batch[0][0]]}-{frame_indices[batch[-1][0]]}: {e}")
+            for position, _, _ in batch:
+                labels[position] = FAILED_LABEL
+            continue
+        if time_to_first_result is None:
+            time_to_first_result = time.perf_counter() - started
+        frames_inferred += len(batch)
+        registry.observe('batch_size', len(batch), BATCH_SIZE_BUCKETS)
+        logit_batches.append(([position for position, _, _ in batch], output.numpy().astype(np.float16)))
+
+        for (position, _, frame), predicted_index in zip(batch, indices):
+            labels[position] = predicted_index
+
+            # Keep an example image for each label
+            if predicted_index not in example_frames:
+                example_frames[predicted_index] = (frame_indices[position], frame)
+
+        if on_progress is not None:
+            if tracker is None:
+                # The decoder knows the fps once the first frame is out
+                tracker = SegmentTracker(decode_stats.get('fps') or 1.0)
+            on_progress(dict(decode_stats, frames_inferred=frames_inferred),
+                        _close_segments(tracker, frame_indices, labels, sampler))
+
+    print(f"Decoded {decode_stats['frames_read']} frames at {decode_stats['decode_fps']:.1f} frames/sec, "
+          f"sampled {decode_stats['frames_sampled']} ({sampling_mode} mode)")
+
+    stats = dict(decode_stats, time_to_first_result=time_to_first_result)
+    registry.observe('decode_seconds', decode_stats['decode_seconds'])
+    registry.inc('frames_decoded_total', decode_stats['frames_sampled'])
+    registry.inc('frames_inferred_total', frames_inferred)
+
+    frame_indices = np.array(frame_indices, dtype=np.int64)
+    labels = np.array(labels, dtype=np.int8)
+    logits = np.zeros((len(labels), logit_batches[0][1].shape[1] if logit_batches else len(index_to_class)),
+                      dtype=np.float16)
+    for positions, batch_logits in logit_batches:
+        logits[positions] = batch_logits
+
+    # Skipped frames take the label and logits of the frame they were matched against
+    if sampler is not None:
+        if sampler.reused:
+            skipped = np.fromiter(sampler.reused.keys(), dtype=np.int64, count=len(sampler.reused))
+            references = np.fromiter(sampler.reused.values(), dtype=np.int64, count=len(sampler.reused))
+            labels[skipped] = labels[references]
+            logits[skipped] = logits[references]
+        stats.update(sampler.stats())
+        print(f"Adaptive sampling skipped {stats['skip_ratio']:.1%} of sampled frames")
+
+    if cascade is not None:
+        stats.update(cascade.stats())
+        registry.inc('frames_escalated_total', stats['cascade_escalated'])
+        print(f"Cascade sent {stats['cascade_rate']:.1%} of inferred frames through the full model")
+
+    if on_progress is not None:
+        if tracker is None:
+            tracker = SegmentTracker(decode_stats.get('fps') or 1.0)
+        closed = _close_segments(tracker, frame_indices, labels, sampler, final=True)
+        last_segment = tracker.finish()
+        on_progress(dict(stats, frames_inferred=frames_inferred), closed + ([last_segment] if last_segment else []))
+
+    # Frames of failed batches have no prediction
+    predicted = labels >= 0
+    return (frame_indices[predicted], labels[predicted], logits[predicted]), example_frames, stats
+
+def _number_frames(frames, frame_indices, labels):
+    # Runs on the decoder thread while _close_segments reads both lists: a frame index is only
+    # appended once its label slot exists
+    for frame_index, timestamp, frame in frames:
+        labels.append(PENDING_LABEL)
+        frame_indices.append(frame_index)
+        yield len(frame_indices) - 1, timestamp, frame
+
+def _close_segments(tracker, frame_indices, labels, sampler, final=False):
+    # Feed the tracker the decoded frames it has not seen yet, reused frames included, up to the
+    # first one still waiting for the model: the decoder runs ahead of inference. Frames of failed
+    # batches are skipped, and so are frames never inferred at all once the video is done (final)
+    closed = []
+    for position in range(tracker.position, min(len(frame_indices), len(labels))):
+        label = int(labels[position])
+        if label == PENDING_LABEL and sampler is not None and position in sampler.reused:
+            label = int(labels[sampler.reused[position]])
+        if label == PENDING_LABEL and not final:
+            break
+        if label >= 0:
+            segment = tracker.add(int(frame_indices[position]), label)
+            if segment is not None:
+                closed.append(segment)
+        tracker.position = position + 1
+    return closed
+
+def summarize_video(predictions, example_frames, fps, workspace, image_prefix='', part=None):
+    """
+    Turn per-frame predictions into the segments, label counts and example images shown to the user.
+
+    The logits are kept in the workspace as well, see logit_store.
+
+    :param predictions: (frame_indices, labels, logits) tuple as returned by analyze_video.
+    :param workspace: Directory the example images are written to.
+    :param image_prefix: Prepended to the image filenames, relative to the folder they are served from.
+    :param part: First sample of the chunk being summarized, None for a complete video.
+    :return: Tuple (segments, label_occurrences, example_images) where example_images maps each
+             label to [frame_index, image filename].
+    """
+    frame_indices, labels, logits = predictions
+    save_logits(workspace, frame_indices, logits, fps, part)
+    with registry.timer('aggregation_seconds'):
+        # Segments, counts and first frames come out of a single run-length pass over the labels
+        segments, label_occurrences, _ = summarize_labels(frame_indices, labels, fps)
+
+        # Only the example images shown on the results page are written to disk
+        example_images = {index_to_class.get(label, 'Unknown'):
+                              [int(frame_index), image_prefix + save_frame(frame, workspace, frame_index)]
+                          for label, (frame_index, frame) in example_frames.items()}
+    return segments, label_occurrences, example_images
+
+def video_properties(video_path):
+    """
+    :return: Tuple (fps, frame_count) as reported by the container, or (None, None).
+    """
+    video = cv2.VideoCapture(video_path)
+    if not video.isOpened():
+        return None, None
+    fps = video.get(cv2.CAP_PROP_FPS)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    return fps, frame_count
+
+def plan_chunks(video_path, frame_rate, num_chunks, sampling_mode='grab'):
+    """
+    Split a video into sample ranges of roughly equal length.
+
+    Chunks are cut on the sampling grid, so together they sample exactly the frames a serial
+    run would. The last chunk always runs to the end of the video, whatever the container
+    reports as its frame count.
+
+    :return: List of (first, last) sample ranges, a single (0, None) range when the video
+             cannot be split.
+    """
+    fps, frame_count = video_properties(video_path)
+    if num_chunks <= 1 or sampling_mode == 'keyframe' or not fps or not frame_count:
+        return [(0, None)]
+
+    total_samples = math.ceil(frame_count / sampling_step(fps, frame_rate))
+    chunk_size = max(math.ceil(total_samples / num_chunks), 1)
+    bounds = list(range(0, total_samples, chunk_size))
+    return [(first, last) for first, last in zip(bounds, bounds[1:] + [None])]
+
+def merge_segments(chunk_segments, fps):
+    """
+    Stitch the group_consecutive_frames output of consecutive chunks into one list.
+
+    A segment that continues across a chunk boundary is merged back into one, and a segment that
+    ends at a boundary is extended up to the frame before the next segment, as in a serial run.
+    """
+    merged = []
+    for segments in chunk_segments:
+        for segment in segments:
+            segment = dict(segment)
+            if merged and merged[-1]['label'] == segment['label']:
+                merged[-1]['end_frame'] = segment['end_frame']
+                merged[-1]['end_time'] = segment['end_time']
+                continue
+            if merged:
+                merged[-1]['end_frame'] = segment['start_frame'] - 1
+                merged[-1]['end_time'] = merged[-1]['end_frame'] / fps
+            merged.append(segment)
+    return merged
+
+def merge_chunks(chunk_results, fps):
+    """
+    Combine the summarize_video output of every chunk, in video order, into a single result.
+
+    :param chunk_results: List of (segments, label_occurrences, example_images, stats) tuples.
+    :return: Tuple (segments, label_occurrences, example_images, stats) where example_images
+             maps each label to the image filename of its earliest frame.
+    """
+    segments = merge_segments([chunk[0] for chunk in chunk_results], fps)
+
+    label_occurrences = {}
+    example_images = {}
+    for _, chunk_occurrences, chunk_examples, _ in chunk_results:
+        for label, count in chunk_occurrences.items():
+            label_occurrences[label] = label_occurrences.get(label, 0) + count
+        for label, (frame_index, image_file) in chunk_examples.items():
+            if label not in example_images or frame_index < example_images[label][0]:
+                example_images[label] = [frame_index, image_file]
+
+    # Settings such as the sampling mode are the same in every chunk, counters are summed
+    stats = dict(chunk_results[0][3], chunks=len(chunk_results)) if chunk_results else {'chunks': 0}
+    for name in ADDITIVE_STATS:
+        values = [chunk[3][name] for chunk in chunk_results if name in chunk[3]]
+        if values:
+            stats[name] = sum(values)
+    first_results = [chunk[3]['time_to_first_result'] for chunk in chunk_results
+                     if chunk[3].get('time_to_first_result') is not None]
+    stats['time_to_first_result'] = min(first_results) if first_results else None
+    if stats.get('decode_seconds'):
+        # Summed over chunks, so this is the per-worker rate
+        stats['decode_fps'] = stats['frames_read'] / stats['decode_seconds']
+        stats['sampled_fps'] = stats['frames_sampled'] / stats['decode_seconds']
+    if 'frames_reused' in stats:
+        total = stats['frames_inferred'] + stats['frames_reused']
+        stats['skip_ratio'] = stats['frames_reused'] / total if total else 0.0
+    if 'cascade_frames' in stats:
+        stats['cascade_rate'] = stats['cascade_escalated'] / stats['cascade_frames'] if stats['cascade_frames'] else 0.0
+        stats['cascade_agreement'] = (stats['cascade_audit_agreed'] / stats['cascade_audited']
+                                      if stats['cascade_audited'] else None)
+
+    return segments, label_occurrences, {label: image for label, (_, image) in example_images.items()}, stats
+
+# Model of a local pool worker process, loaded once by _init_pool_worker
+_pool_model = None
+
+def _init_pool_worker(inference_backend, num_threads, cascade_margin):
+    global _pool_model
+    configure_threads(num_threads)
+    _pool_model = build_backend(load_combined_model(num_classes=23), inference_backend)
+    if cascade_margin >= 0:
+        _pool_model = CascadeModule(_pool_model, cascade_margin)
+
+def _analyze_pool_chunk(video_path, sample_range, workspace, image_prefix, fps, options):
+    predictions, example_frames, stats = analyze_video(_pool_model, video_path, sample_range=sample_range, **options)
+    return summarize_video(predictions, example_frames, fps, workspace, image_prefix, sample_range[0]) + (stats,)
+
+def analyze_video_parallel(video_path, workers, workspace, image_prefix='', inference_backend='eager',
+                           cascade_margin=-1, **options):
+    """
+    Process the chunks of a video on a local process pool and merge them.
+
+    Every pool process loads its own model from the weight cache. Celery's prefork workers cannot
+    start child processes, so this is meant for the command line and for threaded or solo workers;
+    prefork workers fan chunks out as Celery subtasks instead.
+
+    :param workers: Number of processes, the video is split into as many chunks.
+    :param options: frame_rate, sampling_mode, similarity_threshold and batch_size, as for analyze_video.
+    :return: Tuple (segments, label_occurrences, example_images, stats) as returned by merge_chunks.
+    """
+    fps, _ = video_properties(video_path)
+    chunks = plan_chunks(video_path, options.get('frame_rate', 1), workers, options.get('sampling_mode', 'grab'))
+    num_threads = max(1, (cv2.getNumberOfCPUs() or 1) // len(chunks))
+
+    with ProcessPoolExecutor(len(chunks), initializer=_init_pool_worker,
+                             initargs=(inference_backend, num_threads, cascade_margin)) as pool:
+        futures = [pool.submit(_analyze_pool_chunk, video_path, sample_range, workspace, image_prefix, fps, options)
+                   for sample_range in chunks]
+        results = merge_chunks([future.result() for future in futures], fps)
+    merge_logit_parts(workspace, fps)
+    return results
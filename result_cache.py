@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Where finished results are kept, and how much disk they may use in total
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', 'cache/results/')
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1 << 30))
+
+# Digest of the weights the workers run, written next to the entries for the web process
+WEIGHTS_FILE = '.weights_sha256'
+
+def cache_key(video_sha256, config):
+    """
+    Build the cache key of a video processed with a given configuration.
+
+    :param video_sha256: Digest of the video content.
+    :param config: JSON-serializable dictionary of everything that changes the results
+                   (weights digest, inference backend, sampling options...).
+    :return: Hex digest identifying the result.
+    """
+    payload = json.dumps({'video': video_sha256, 'config': config}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class ResultCache:
+    """
+    Size-bounded, least-recently-used store of finished process_video results.
+
+    Every entry is a directory holding result.json and a copy of its example images, so a hit
+    does not depend on frames that may have been cleaned up since. Other files of the job, such as
+    its stored logits, can be kept alongside.
+    """
+
+    def __init__(self, directory=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, images_folder, image_prefix='', data_folder=None):
+        """
+        Look up a result and copy its example images into images_folder.
+
+        :param image_prefix: Prepended to the image filenames in the returned results, for when
+                             images_folder is a subdirectory of the folder they are served from.
+        :param data_folder: Where to copy the extra files stored with the entry, if any.
+        :return: The cached results tuple, or None on a miss.
+        """
+        entry_path = self._entry_path(key)
+        result_path = os.path.join(entry_path, 'result.json')
+        try:
+            with open(result_path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        os.makedirs(images_folder, exist_ok=True)
+        example_images = {}
+        for label, image_file in entry['results'][2].items():
+            image_file = os.path.basename(image_file)
+            try:
+                shutil.copyfile(os.path.join(entry_path, 'images', image_file), os.path.join(images_folder, image_file))
+            except FileNotFoundError:
+                # Entry is incomplete, treat it as a miss and let it be rebuilt
+                shutil.rmtree(entry_path, ignore_errors=True)
+                return None
+            example_images[label] = image_prefix + image_file
+        entry['results'][2] = example_images
+
+        data_path = os.path.join(entry_path, 'data')
+        if data_folder is not None and os.path.isdir(data_path):
+            for name in os.listdir(data_path):
+                shutil.copyfile(os.path.join(data_path, name), os.path.join(data_folder, name))
+
+        # The modification time of result.json is the recency used for eviction
+        os.utime(result_path)
+        return tuple(entry['results'])
+
+    def contains(self, key):
+        """
+        Whether a result is stored, without copying anything out of it.
+        """
+        return os.path.exists(os.path.join(self._entry_path(key), 'result.json'))
+
+    def put(self, key, results, images_folder, weights_sha256=None, data_files=()):
+        """
+        Store a results tuple (segments, label counts, example images, stats) and its images.
+
+        :param data_files: Paths of extra files to keep with the entry, missing ones are skipped.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.staging-')
+        try:
+            os.makedirs(os.path.join(staging, 'images'))
+            for image_file in results[2].values():
+                shutil.copyfile(os.path.join(images_folder, image_file),
+                                os.path.join(staging, 'images', os.path.basename(image_file)))
+            os.makedirs(os.path.join(staging, 'data'))
+            for data_file in data_files:
+                if os.path.exists(data_file):
+                    shutil.copyfile(data_file, os.path.join(staging, 'data', os.path.basename(data_file)))
+            with open(os.path.join(staging, 'result.json'), 'w') as f:
+                json.dump({'weights_sha256': weights_sha256, 'results': list(results)}, f)
+
+            entry_path = self._entry_path(key)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            os.replace(staging, entry_path)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict()
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in names if not name.startswith('.')]
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for entry_path in self._entries():
+            try:
+                last_used = os.path.getmtime(os.path.join(entry_path, 'result.json'))
+            except OSError:
+                last_used = 0
+            entries.append((last_used, _directory_size(entry_path), entry_path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total -= size
+
+    def invalidate_weights(self, weights_sha256):
+        """
+        Remove every entry produced with weights other than weights_sha256, and record them as the
+        weights results are now computed with, see current_weights. Nothing is done for weights of
+        unknown digest, such as a local file passed to load_combined_model.
+        """
+        if weights_sha256 is None:
+            print("Warning: Weights of unknown digest, the result cache is left as it is.")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.weights-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(weights_sha256)
+        os.replace(temp_path, os.path.join(self.directory, WEIGHTS_FILE))
+
+        for entry_path in self._entries():
+            try:
+                with open(os.path.join(entry_path, 'result.json')) as f:
+                    stale = json.load(f).get('weights_sha256') != weights_sha256
+            except (OSError, json.JSONDecodeError):
+                stale = True
+            if stale:
+                shutil.rmtree(entry_path, ignore_errors=True)
+
+    def current_weights(self):
+        """
+        Digest of the weights the workers last loaded, for processes that never load them.
+
+        :return: Hex digest, or None if no worker started yet.
+        """
+        try:
+            with open(os.path.join(self.directory, WEIGHTS_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,307 @@
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import cv2
+from celery import chord
+from celery.concurrency import get_implementation
+from celery.signals import worker_init, worker_process_init, task_postrun
+from celery_app import (celery, PROCESS_VIDEO_TASK, WORKER_CONCURRENCY, FRAMES_FOLDER, UPLOAD_FOLDER,
+                        UPLOAD_SESSIONS_FOLDER,
+                        FRAME_RATE, SAMPLING_MODE, ADAPTIVE_THRESHOLD, INFERENCE_BACKEND, CASCADE_MARGIN,
+                        PROGRESS_INTERVAL, PROGRESS_SEGMENTS, result_cache, results_config, current_weights_digest)
+from utils import sampling_step
+from pipeline import (analyze_video, summarize_video, plan_chunks, merge_chunks, analyze_video_parallel,
+                      video_properties, configure_threads)
+from model import load_combined_model
+from backends import build_backend, CascadeModule
+from inference_server import BatchingInferenceServer, RemoteModel
+from result_cache import cache_key
+from workspaces import create_workspace, cleanup_workspaces, workspace_path
+from logit_store import LOGIT_FILES, merge_logit_parts
+from uploads import follow_upload, load_session, edit_session, finish_session
+from metrics import registry
+
+# Celery tasks, run with `celery -A tasks worker`. Everything heavy (torch, OpenCV, the model) is
+# imported here and never by the web process.
+
+# Each worker process gets an equal share of the cores to avoid oversubscribing them. Inference
+# gets TORCH_THREADS of them; decoding and PREPROCESS_THREADS resizing threads run alongside it,
+# with at most PIPELINE_DEPTH preprocessed batches waiting for the model, see analyze_video.
+# Shares of four cores or more leave one core to those stages.
+CORES_PER_WORKER = max(1, (os.cpu_count() or 1) // WORKER_CONCURRENCY)
+TORCH_THREADS = int(os.environ.get('TORCH_THREADS',
+                                   CORES_PER_WORKER - 1 if CORES_PER_WORKER >= 4 else CORES_PER_WORKER))
+TORCH_INTEROP_THREADS = int(os.environ.get('TORCH_INTEROP_THREADS', 1))
+OPENCV_THREADS = int(os.environ.get('OPENCV_THREADS', 1))
+PREPROCESS_THREADS = int(os.environ.get('PREPROCESS_THREADS', 2))
+PIPELINE_DEPTH = int(os.environ.get('PIPELINE_DEPTH', 2))
+
+# Number of frames sent through the model in a single forward pass
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 16))
+
+# One in CASCADE_AUDIT_EVERY frames the cascade is confident about is repeated at full resolution
+# anyway, to measure the agreement, see CASCADE_MARGIN
+CASCADE_AUDIT_EVERY = int(os.environ.get('CASCADE_AUDIT_EVERY', 50))
+
+# Split long videos into PARALLEL_CHUNKS time ranges processed side by side: 'celery' fans them
+# out as subtasks, 'processes' uses a local process pool (threaded or solo workers only)
+PARALLEL_MODE = os.environ.get('PARALLEL_MODE', 'serial')
+PARALLEL_CHUNKS = int(os.environ.get('PARALLEL_CHUNKS', os.cpu_count() or 1))
+
+# When set, every serial process_video run writes a torch profiler trace to <PROFILE_DIR>/<task id>.json
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+# Where the forward passes run, see inference_server.py: unset loads the model in every worker
+# process, 'thread' merges the batches of all tasks of a threaded worker (`celery -A tasks worker
+# --pool threads`) in one in-process server, and a Unix socket path sends them to the sidecar
+# shared by every worker of the machine (`python inference_server.py --socket <path>`)
+INFERENCE_SERVER = os.environ.get('INFERENCE_SERVER', '')
+# A merged batch runs once it holds SERVER_MAX_BATCH_SIZE frames or SERVER_MAX_LATENCY seconds
+# after its first request
+SERVER_MAX_BATCH_SIZE = int(os.environ.get('SERVER_MAX_BATCH_SIZE', 32))
+SERVER_MAX_LATENCY = float(os.environ.get('SERVER_MAX_LATENCY', 0.01))
+
+# Load the model
+model = None
+# Seconds this process spent loading the model, reported with every result
+model_load_seconds = None
+# Tasks of a threaded worker may ask for the model at the same time
+_model_lock = threading.Lock()
+def get_model():
+    global model, model_load_seconds
+    with _model_lock:
+        if model is None:
+            started = time.perf_counter()
+            model = load_inference_model()
+            if CASCADE_MARGIN >= 0:
+                model = CascadeModule(model, CASCADE_MARGIN, audit_every=CASCADE_AUDIT_EVERY)
+            model_load_seconds = time.perf_counter() - started
+            registry.observe('model_load_seconds', model_load_seconds)
+    return model
+
+def load_inference_model():
+    if INFERENCE_SERVER not in ('', 'thread'):
+        # The sidecar holds the weights and publishes their digest, see current_weights_digest
+        print(f"Using the inference server on {INFERENCE_SERVER}")
+        return RemoteModel(INFERENCE_SERVER)
+
+    print("Loading the model...")
+    model = load_combined_model(num_classes=23)  # Lazy load the model
+    model.eval()  # Set the model to evaluation mode
+    # Results computed with any other weights are no longer valid
+    result_cache.invalidate_weights(model.weights_sha256)
+    model = build_backend(model, INFERENCE_BACKEND)
+    if INFERENCE_SERVER == 'thread':
+        model = BatchingInferenceServer(model, SERVER_MAX_BATCH_SIZE, SERVER_MAX_LATENCY)
+    return model
+
+@worker_process_init.connect
+def preload_model(**kwargs):
+    configure_threads(TORCH_THREADS, TORCH_INTEROP_THREADS, OPENCV_THREADS)
+    # Load the weights once per worker process, before the first task arrives
+    get_model()
+
+@worker_init.connect
+def preload_model_in_main_process(sender, **kwargs):
+    # Threaded, solo and green pools run their tasks in the main process, where
+    # worker_process_init never fires; prefork children load the model themselves
+    if get_implementation(sender.pool_cls).__module__ != 'celery.concurrency.prefork':
+        preload_model()
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    # Make what this worker measured visible to the /metrics route of the web process
+    registry.flush()
+
+@contextmanager
+def profile_task(job_id):
+    if not PROFILE_DIR:
+        yield
+        return
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as profiler:
+        yield
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.export_chrome_trace(os.path.join(PROFILE_DIR, f"{job_id}.json"))
+
+@celery.task(bind=True, name=PROCESS_VIDEO_TASK)
+def process_video(self, video_path, frame_rate=FRAME_RATE, sampling_mode=SAMPLING_MODE,
+                  similarity_threshold=ADAPTIVE_THRESHOLD, video_sha256=None, enqueued_at=None, upload_id=None):
+    # Chunked uploads are passed by upload_id, video_path and video_sha256 are None then
+    follow = None
+    if upload_id is not None:
+        session = load_session(UPLOAD_SESSIONS_FOLDER, upload_id)
+        if session['uploaded'] and not session['complete']:
+            # Every byte arrived: check and store the upload before processing it
+            session = finish_session(UPLOAD_SESSIONS_FOLDER, session, UPLOAD_FOLDER)
+        if session['complete']:
+            video_path, video_sha256 = session['video_path'], session['video_sha256']
+        else:
+            # Still arriving, processed as it comes in
+            follow = follow_upload(UPLOAD_SESSIONS_FOLDER, upload_id)
+            video_path, _ = follow()
+
+    task_started = time.perf_counter()
+    was_loaded = model_load_seconds is not None
+    queue_wait_seconds = max(time.time() - enqueued_at, 0.0) if enqueued_at else None
+    if queue_wait_seconds is not None:
+        registry.observe('queue_wait_seconds', queue_wait_seconds)
+
+    # Frames of this job live in static/frames/<job id>/, old workspaces are dropped first
+    job_id = self.request.id or uuid.uuid4().hex
+    cleanup_workspaces(FRAMES_FOLDER, keep=(job_id,))
+    workspace = create_workspace(FRAMES_FOLDER, job_id)
+
+    if upload_id is not None and follow is None:
+        # The web process only knows the digest of form uploads, chunked ones are looked up here
+        results = result_cache.get(cache_key(video_sha256, results_config(frame_rate, sampling_mode,
+                                                                          similarity_threshold)),
+                                   workspace, image_prefix=f"{job_id}/", data_folder=workspace)
+        if results is not None:
+            results[3].update(result_cache='hit', job_id=job_id)
+            registry.inc('result_cache_hits_total')
+            return results
+
+    fps = extract_fps(video_path)
+    if fps is None:
+        # Fails the task, which the status page and the progress stream report as an error
+        raise ValueError("Could not extract FPS from the video")
+
+    options = dict(frame_rate=frame_rate, sampling_mode=sampling_mode,
+                   similarity_threshold=similarity_threshold, batch_size=BATCH_SIZE,
+                   preprocess_threads=PREPROCESS_THREADS, queue_depth=PIPELINE_DEPTH)
+    if PARALLEL_MODE == 'celery' and PARALLEL_CHUNKS > 1 and follow is None:
+        # Fan the chunks out as subtasks, the merge task takes over this task's id
+        chunks = plan_chunks(video_path, frame_rate, PARALLEL_CHUNKS, sampling_mode)
+        if len(chunks) > 1:
+            print(f"Splitting {video_path} into {len(chunks)} chunks")
+            raise self.replace(chord(
+                [process_video_chunk.s(video_path, sample_range, job_id, fps, options) for sample_range in chunks],
+                merge_video_chunks.s(fps, job_id, frame_rate, sampling_mode, similarity_threshold, video_sha256)))
+
+    if PARALLEL_MODE == 'processes' and PARALLEL_CHUNKS > 1 and follow is None:
+        model_wait_seconds = 0.0
+        results = analyze_video_parallel(video_path, PARALLEL_CHUNKS, workspace, f"{job_id}/",
+                                         inference_backend=INFERENCE_BACKEND, cascade_margin=CASCADE_MARGIN,
+                                         **options)
+    else:
+        model = get_model()
+        model_wait_seconds = time.perf_counter() - task_started
+        progress = TaskProgress(self, None if follow else video_path, frame_rate)
+        try:
+            with profile_task(job_id):
+                predictions, example_frames, stats = analyze_video(model, video_path, on_progress=progress,
+                                                                   follow=follow, **options)
+        except Exception:
+            if follow is not None:
+                forget_stalled_task(upload_id)
+            raise
+        summary = summarize_video(predictions, example_frames, fps, workspace, f"{job_id}/")
+        results = merge_chunks([summary + (stats,)], fps)
+
+    stats = results[3]
+    stats.update(job_id=job_id, model_load_seconds=model_load_seconds, model_was_loaded=was_loaded,
+                 model_wait_seconds=model_wait_seconds, queue_wait_seconds=queue_wait_seconds)
+    registry.observe('task_seconds', time.perf_counter() - task_started)
+    registry.inc('videos_processed_total')
+    if stats.get('time_to_first_result') is not None:
+        stats['time_to_first_result'] += model_wait_seconds
+    print(f"Model load {model_load_seconds or 0:.2f}s ({'warm' if was_loaded else 'cold'} worker), "
+          f"first result after {stats.get('time_to_first_result') or 0:.2f}s")
+
+    if follow is not None:
+        # The whole upload was decoded, check and store it; its digest keys the cached results
+        session = finish_session(UPLOAD_SESSIONS_FOLDER, load_session(UPLOAD_SESSIONS_FOLDER, upload_id),
+                                 UPLOAD_FOLDER)
+        video_sha256 = session['video_sha256']
+
+    return store_results(results, video_sha256, frame_rate, sampling_mode, similarity_threshold)
+
+def forget_stalled_task(upload_id):
+    # Gave up on an upload still arriving, it gets a new task if it is resumed and completed
+    try:
+        with edit_session(UPLOAD_SESSIONS_FOLDER, upload_id) as session:
+            if not session['uploaded']:
+                session['task_id'] = None
+    except FileNotFoundError:
+        pass
+
+class TaskProgress:
+    """
+    Publish the progress of process_video and the last segments closed through the task state,
+    with the number of segments before them in 'segments_offset'.
+    """
+
+    def __init__(self, task, video_path, frame_rate):
+        """
+        :param video_path: Path of the video, None when its length is not known yet.
+        """
+        self.task = task
+        self.started = time.perf_counter()
+        self.last_update = 0.0
+        self.segments = []
+
+        fps, frame_count = video_properties(video_path) if video_path else (None, None)
+        self.frames_total = math.ceil(frame_count / sampling_step(fps, frame_rate)) if fps and frame_count else None
+
+    def __call__(self, counters, closed_segments):
+        self.segments.extend(closed_segments)
+        now = time.perf_counter()
+        if now - self.last_update < PROGRESS_INTERVAL:
+            return
+        self.last_update = now
+
+        elapsed = now - self.started
+        frames_decoded = counters.get('frames_sampled', 0)
+        throughput = frames_decoded / elapsed if elapsed else 0.0
+        eta = None
+        if self.frames_total and throughput:
+            eta = max(self.frames_total - frames_decoded, 0) / throughput
+
+        # Task ids are only known when running as a Celery task, not when called directly
+        if self.task.request.id:
+            offset = max(len(self.segments) - PROGRESS_SEGMENTS, 0)
+            self.task.update_state(state='PROGRESS', meta={
+                'frames_decoded': frames_decoded,
+                'frames_inferred': counters.get('frames_inferred', 0),
+                'frames_total': self.frames_total,
+                'elapsed': elapsed,
+                'throughput': throughput,
+                'eta': eta,
+                'segments_offset': offset,
+                'segments': self.segments[offset:],
+            })
+
+@celery.task
+def process_video_chunk(video_path, sample_range, job_id, fps, options):
+    workspace = create_workspace(FRAMES_FOLDER, job_id)
+    predictions, example_frames, stats = analyze_video(get_model(), video_path, sample_range=sample_range, **options)
+    return summarize_video(predictions, example_frames, fps, workspace, f"{job_id}/", sample_range[0]) + (stats,)
+
+@celery.task
+def merge_video_chunks(chunk_results, fps, job_id, frame_rate, sampling_mode, similarity_threshold, video_sha256=None):
+    # Chord results come back in the order the chunks were submitted, i.e. in video order
+    results = merge_chunks(chunk_results, fps)
+    merge_logit_parts(create_workspace(FRAMES_FOLDER, job_id), fps)
+    results[3]['job_id'] = job_id
+    return store_results(results, video_sha256, frame_rate, sampling_mode, similarity_threshold)
+
+def store_results(results, video_sha256, frame_rate, sampling_mode, similarity_threshold):
+    if video_sha256 is not None:
+        key = cache_key(video_sha256, results_config(frame_rate, sampling_mode, similarity_threshold))
+        # The stored logits go along, so cached results can be re-aggregated too
+        workspace = workspace_path(FRAMES_FOLDER, results[3]['job_id'])
+        result_cache.put(key, results, FRAMES_FOLDER, current_weights_digest(),
+                         data_files=[os.path.join(workspace, name) for name in LOGIT_FILES])
+    return results
+
+def extract_fps(video_path):
+    video = cv2.VideoCapture(video_path)
+    if not video.isOpened():
+        return None
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    return fps
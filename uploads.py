@@ -0,0 +1,279 @@
+"""
+Resumable chunked uploads.
+
+A client opens an upload session with the file name and size, then sends the file in consecutive
+chunks, each tagged with the byte offset it starts at. After a dropped connection it asks for the
+offset received so far and carries on from there. Every session lives in the sessions folder as
+<upload id>.part (the bytes received) and <upload id>.json (name, size, options and state).
+
+Containers that can be decoded from their beginning, such as MPEG-TS, Matroska or MP4 files with
+their index first, can be processed while the rest is still arriving, see is_progressive.
+"""
+import fcntl
+import json
+import os
+import struct
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from weights import file_sha256
+
+# Largest video accepted, and largest single chunk
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 20 << 30))
+MAX_CHUNK_BYTES = int(os.environ.get('MAX_CHUNK_BYTES', 64 << 20))
+
+# Processing of a progressive container starts once EARLY_START_BYTES of it arrived, negative
+# waits for the complete file
+EARLY_START_BYTES = int(os.environ.get('EARLY_START_BYTES', 32 << 20))
+
+# Unfinished sessions are dropped after this many seconds without a new chunk
+UPLOAD_SESSION_RETENTION_SECONDS = int(os.environ.get('UPLOAD_SESSION_RETENTION_SECONDS', 24 * 60 * 60))
+
+# Containers that can always be decoded from their beginning
+PROGRESSIVE_EXTENSIONS = ('.ts', '.m2ts', '.mts', '.mpg', '.mpeg', '.mkv', '.webm', '.avi')
+# ISO base media files, progressive only when their index (moov) or fragments (moof) come first
+ISO_BMFF_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+
+def _paths(root, upload_id):
+    # Upload ids are generated by create_session, anything else could point outside of root
+    try:
+        upload_id = uuid.UUID(hex=upload_id).hex
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid upload id '{upload_id}'")
+    base = os.path.join(root, upload_id)
+    return base + '.json', base + '.part'
+
+def _save(root, session):
+    meta_path, _ = _paths(root, session['upload_id'])
+    fd, temp_path = tempfile.mkstemp(dir=root, suffix='.json.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(session, f)
+    os.replace(temp_path, meta_path)
+
+def create_session(root, filename, size, options, sha256=None):
+    """
+    Open an upload session.
+
+    :param filename: Name of the file on the client, only its extension is kept.
+    :param size: Total size of the file in bytes.
+    :param options: JSON-serializable processing options of the upload.
+    :param sha256: Optional digest of the content announced by the client, checked once complete.
+    :return: The session dictionary.
+    """
+    os.makedirs(root, exist_ok=True)
+    session = {
+        'upload_id': uuid.uuid4().hex,
+        'extension': os.path.splitext(filename)[1].lower(),
+        'size': size,
+        'sha256': sha256,
+        'options': options,
+        'created': time.time(),
+        # Every byte arrived, and the file was checked and moved into the upload folder
+        'uploaded': False,
+        'complete': False,
+        'video_path': None,
+        'video_sha256': None,
+        'task_id': None,
+    }
+    _, part_path = _paths(root, session['upload_id'])
+    open(part_path, 'wb').close()
+    _save(root, session)
+    return session
+
+def load_session(root, upload_id):
+    """
+    :return: The session dictionary with the number of bytes received so far in 'received'.
+    :raises ValueError: If upload_id is malformed.
+    :raises FileNotFoundError: If there is no such session.
+    """
+    meta_path, part_path = _paths(root, upload_id)
+    with open(meta_path) as f:
+        # Sessions are rewritten in place, see edit_session
+        fcntl.flock(f, fcntl.LOCK_SH)
+        session = json.load(f)
+    try:
+        session['received'] = session['size'] if session['complete'] else os.path.getsize(part_path)
+    except FileNotFoundError:
+        # Only while finish_session moves the part into place
+        session['received'] = 0
+    return session
+
+@contextmanager
+def edit_session(root, upload_id):
+    """
+    Lock a stored session for a read-modify-write, the web process and the workers change the same
+    session. Yields the session dictionary, which is stored back unless the block raises.
+
+    :raises FileNotFoundError: If there is no such session.
+    """
+    meta_path, _ = _paths(root, upload_id)
+    with open(meta_path, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        session = json.load(f)
+        yield session
+        f.seek(0)
+        json.dump(session, f)
+        f.truncate()
+
+def update_session(root, upload_id, **values):
+    """
+    Set fields of a stored session, such as the id of the task processing it.
+    """
+    with edit_session(root, upload_id) as session:
+        session.update(values)
+    return session
+
+def append_chunk(root, session, offset, stream, chunk_size=1 << 20):
+    """
+    Append a chunk to the received part of an upload.
+
+    Chunks of one session are written one at a time, even from several processes, and never
+    beyond the announced size.
+
+    :param offset: Byte offset the chunk starts at, must be the number of bytes received so far.
+    :param stream: File-like object the chunk is read from.
+    :return: Number of bytes received after the chunk.
+    :raises ValueError: If offset is not the end of the received part, or the chunk goes past the
+                        announced size. Nothing is written then.
+    """
+    _, part_path = _paths(root, session['upload_id'])
+    with open(part_path, 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        received = f.seek(0, os.SEEK_END)
+        if offset != received:
+            raise ValueError(f"Chunk starts at byte {offset} but {received} bytes were received")
+        for data in iter(lambda: stream.read(chunk_size), b''):
+            if f.tell() + len(data) > session['size']:
+                f.truncate(received)
+                raise ValueError(f"Chunk goes past the announced size of {session['size']} bytes")
+            f.write(data)
+        return f.tell()
+
+def finish_session(root, session, upload_folder):
+    """
+    Move a completely received upload into upload_folder, named after the SHA-256 of its content.
+
+    An upload identical to a video already stored is dropped in favour of the stored one. Hashing
+    reads the whole file, so this runs in the worker rather than in a web request.
+
+    :return: The updated session, with 'video_path' and 'video_sha256' set.
+    :raises ValueError: If the content does not match the digest announced by the client, the
+                        session is removed then.
+    """
+    _, part_path = _paths(root, session['upload_id'])
+    video_sha256 = file_sha256(part_path)
+    if session['sha256'] and session['sha256'] != video_sha256:
+        remove_session(root, session['upload_id'])
+        raise ValueError(f"Upload does not match its announced digest {session['sha256']}")
+
+    video_path = os.path.join(upload_folder, video_sha256 + session['extension'])
+    if not os.path.exists(video_path):
+        # The part is linked first and removed only once the session points to the video, so a
+        # task following the upload always finds one of the two
+        try:
+            os.link(part_path, video_path)
+        except OSError:
+            os.replace(part_path, video_path)
+    session = update_session(root, session['upload_id'], complete=True, video_path=video_path,
+                             video_sha256=video_sha256)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    return session
+
+def remove_session(root, upload_id):
+    for path in _paths(root, upload_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def find_upload(upload_folder, video_sha256):
+    """
+    :return: Path of a stored video with the given content digest, or None.
+    """
+    if not video_sha256:
+        return None
+    try:
+        names = os.listdir(upload_folder)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if os.path.splitext(name)[0] == video_sha256:
+            return os.path.join(upload_folder, name)
+    return None
+
+def follow_upload(root, upload_id):
+    """
+    :return: Callable returning the (path, complete) pair of an upload, see utils.iter_frames.
+    :raises FileNotFoundError: From the callable, once the session was removed.
+    """
+    def follow():
+        try:
+            session = load_session(root, upload_id)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Upload {upload_id} was removed before it was complete")
+        if session['complete']:
+            return session['video_path'], True
+        return _paths(root, upload_id)[1], session['uploaded']
+    return follow
+
+def _iso_bmff_layout(path, received):
+    # Walk the top-level boxes: True if the index or a fragment comes before the media data,
+    # False if the media data comes first, None if the received part does not tell yet
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset + 8 <= received:
+            f.seek(offset)
+            size, kind = struct.unpack('>I4s', f.read(8))
+            if kind in (b'moov', b'moof'):
+                return True
+            if kind == b'mdat':
+                return False
+            if size == 1:
+                if offset + 16 > received:
+                    return None
+                size = struct.unpack('>Q', f.read(8))[0]
+            if size < 8:
+                # Box running to the end of the file, or a malformed one
+                return False
+            offset += size
+    return None
+
+def is_progressive(root, session, received):
+    """
+    Whether the first received bytes of an upload can already be decoded.
+
+    :return: True or False, None when more of the file is needed to tell.
+    """
+    if session['extension'] in PROGRESSIVE_EXTENSIONS:
+        return True
+    if session['extension'] in ISO_BMFF_EXTENSIONS:
+        return _iso_bmff_layout(_paths(root, session['upload_id'])[1], received)
+    return False
+
+def cleanup_sessions(root, max_age=UPLOAD_SESSION_RETENTION_SECONDS):
+    """
+    Remove the sessions that did not receive anything for max_age seconds.
+
+    :return: Number of sessions removed.
+    """
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+    now = time.time()
+    removed = 0
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        upload_id = name[:-len('.json')]
+        try:
+            meta_path, part_path = _paths(root, upload_id)
+            last_change = max(os.path.getmtime(path) for path in (meta_path, part_path) if os.path.exists(path))
+        except (ValueError, OSError):
+            continue
+        if now - last_change > max_age:
+            remove_session(root, upload_id)
+            removed += 1
+    return removed
@@ -1,36 +1,44 @@
 import os
-import cv2
-from PIL import Image
-import torch
+import time
 from collections import Counter
-import matplotlib.pyplot as plt
-class_description = {
-    "lower-gi-tract/anatomical-landmarks/cecum": "The cecum is the beginning of the large intestine and is a critical anatomical landmark in the lower gastrointestinal tract. It plays a role in absorbing fluids and salts that remain after intestinal digestion and absorption.",
-    "lower-gi-tract/anatomical-landmarks/ileum": "The ileum is the final section of the small intestine, where absorption of vitamin B12 and bile salts occurs. It is a key anatomical landmark in the lower gastrointestinal tract.",
-    "lower-gi-tract/anatomical-landmarks/retroflex-rectum": "Retroflex view of the rectum is an endoscopic technique used to inspect the rectum more thoroughly, especially for polyps or other abnormalities.",
-    "lower-gi-tract/pathological-findings/hemorrhoids": "Hemorrhoids are swollen veins in the lower rectum or anus, often causing discomfort, itching, or bleeding. They are a common pathological finding in the lower gastrointestinal tract.",
-    "lower-gi-tract/pathological-findings/polyps": "Polyps are abnormal growths of tissue that form on the lining of the colon or rectum. They can vary in size and have the potential to develop into colorectal cancer if left untreated.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-0-1": "Ulcerative Colitis Grade 0-1 indicates minimal to mild inflammation of the colon, characterized by superficial ulcerations and erythema. It is an early stage of the disease in the lower gastrointestinal tract.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1": "Ulcerative Colitis Grade 1 is marked by mild inflammation in the colon with superficial ulcerations and erythema. It is an early stage of ulcerative colitis.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-1-2": "Ulcerative Colitis Grade 1-2 represents moderate inflammation of the colon, with more pronounced ulcerations and erythema. This stage indicates a progression of the disease.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2": "Ulcerative Colitis Grade 2 involves moderate inflammation and ulceration in the colon. It is a more advanced stage of the disease, requiring careful monitoring.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-2-3": "Ulcerative Colitis Grade 2-3 indicates severe inflammation with extensive ulceration and erythema. This stage of the disease requires aggressive treatment.",
-    "lower-gi-tract/pathological-findings/ulcerative-colitis-grade-3": "Ulcerative Colitis Grade 3 is characterized by severe inflammation, deep ulcerations, and extensive tissue damage in the colon. It is the most advanced stage of the disease.",
-    "lower-gi-tract/quality-of-mucosal-views/bbps-0-1": "The Boston Bowel Preparation Scale (BBPS) score of 0-1 indicates poor bowel preparation, with a significant amount of stool obstructing the view during a colonoscopy, affecting the quality of mucosal views.",
-    "lower-gi-tract/quality-of-mucosal-views/bbps-2-3": "The Boston Bowel Preparation Scale (BBPS) score of 2-3 indicates fair to good bowel preparation, with partial to clear views of the mucosa during a colonoscopy, allowing for a more thorough examination.",
-    "lower-gi-tract/quality-of-mucosal-views/impacted-stool": "Impacted stool refers to a large, hard mass of stool that is stuck in the colon or rectum. It can obscure the view during endoscopic procedures, compromising the quality of mucosal views.",
-    "lower-gi-tract/therapeutic-interventions/dyed-lifted-polyps": "Dyed lifted polyps refer to polyps that have been injected with a dye solution to lift them away from the mucosal layer during an endoscopic procedure, facilitating their removal.",
-    "lower-gi-tract/therapeutic-interventions/dyed-resection-margins": "Dyed resection margins refer to the edges of tissue that have been stained with dye during an endoscopic procedure to ensure that the entire lesion or polyp has been removed.",
-    "upper-gi-tract/anatomical-landmarks/pylorus": "The pylorus is the opening from the stomach into the duodenum (first part of the small intestine). It is an important anatomical landmark in the upper gastrointestinal tract, controlling the passage of stomach contents.",
-    "upper-gi-tract/anatomical-landmarks/retroflex-stomach": "Retroflex view of the stomach is an endoscopic technique used to inspect the upper part of the stomach, especially for detecting abnormalities such as polyps, ulcers, or tumors.",
-    "upper-gi-tract/anatomical-landmarks/z-line": "The Z-line, or squamocolumnar junction, is where the esophagus meets the stomach. It is an important anatomical landmark in the upper gastrointestinal tract, often inspected for signs of Barrett's esophagus or other conditions.",
-    "upper-gi-tract/pathological-findings/barretts": "Barrett's esophagus is a condition in which the lining of the esophagus changes to resemble the lining of the stomach, increasing the risk of esophageal cancer. It is a significant pathological finding in the upper gastrointestinal tract.",
-    "upper-gi-tract/pathological-findings/barretts-short-segment": "Barrett's esophagus with a short segment refers to a limited area of the esophagus where the lining has changed to resemble the stomach lining. This condition increases the risk of developing esophageal cancer.",
-    "upper-gi-tract/pathological-findings/esophagitis-a": "Esophagitis Grade A indicates mild inflammation of the esophagus, often due to acid reflux. It is characterized by small, isolated areas of erosion in the lining of the esophagus.",
-    "upper-gi-tract/pathological-findings/esophagitis-b-d": "Esophagitis Grades B-D represent progressively severe inflammation and damage to the esophagus lining, often due to acid reflux, with Grade D being the most severe, involving extensive erosion."
-}
+from descriptions import description_index
+
+# cv2, torch, PIL and matplotlib are imported by the functions that use them, so that the web
+# process can use the label tables and sampling settings without loading them
+
+# Frame sampling strategies supported by iter_frames
+SAMPLING_MODES = ('grab', 'seek', 'keyframe')
+
+# How frames become model inputs, see pipeline.preprocess_batch. Results of another version are
+# not served from the result cache
+PREPROCESSING_VERSION = 'opencv-area'
+
+# In 'seek' mode, gaps shorter than this many frames are skipped with grab() instead of seeking
+SEEK_MIN_GAP = 60
+
+# A video that is still being written is decoded again once it grew by FOLLOW_MIN_GROWTH bytes,
+# checked every FOLLOW_POLL_SECONDS, and given up on after FOLLOW_STALL_SECONDS without growth,
+# which frees the worker when a client abandons an upload
+FOLLOW_MIN_GROWTH = 8 << 20
+FOLLOW_POLL_SECONDS = 1.0
+FOLLOW_STALL_SECONDS = float(os.environ.get('FOLLOW_STALL_SECONDS', 5 * 60))
+
+def _seek(video, video_path, target_frame):
+    # A partly written file may not have its index yet, seeking can then fail or land on another
+    # frame. Frame indices would be wrong from an unknown position, so the video is opened again
+    # and grabbed from its start instead. Returns (capture, position, whether the seek worked)
+    import cv2
+
+    if video.set(cv2.CAP_PROP_POS_FRAMES, target_frame):
+        position = int(video.get(cv2.CAP_PROP_POS_FRAMES))
+        if 0 <= position <= target_frame:
+            return video, position, True
+    video.release()
+    return cv2.VideoCapture(video_path), 0, False
+
+def _iter_capture_frames(video_path, frame_rate, mode, stats, sample_range):
+    import cv2
 
-def extract_frames(video_path, output_folder, frame_rate=1):
     video = cv2.VideoCapture(video_path)
 
     if not video.isOpened():
@@ -38,25 +46,202 @@ def extract_frames(video_path, output_folder, frame_rate=1):
         return
 
     fps = video.get(cv2.CAP_PROP_FPS)
-    interval = int(fps / frame_rate)
-
-    os.makedirs(output_folder, exist_ok=True)
+    if not fps > 0:
+        print("Warning: Video reports no FPS, sampling every frame.")
+    step = sampling_step(fps, frame_rate)
+    stats['fps'] = fps
 
+    sampled, last_sample = sample_range or (0, None)
+    target_frame = int(round(sampled * step))
     current_frame = 0
-    extracted_frame = 0
-    while video.isOpened():
-        ret, frame = video.read()
-        if not ret:
+    seekable = True
+    try:
+        if target_frame > 0:
+            # Chunks that do not start at the beginning always seek to their first sample
+            video, current_frame, seekable = _seek(video, video_path, target_frame)
+        while last_sample is None or sampled < last_sample:
+            if mode == 'seek' and seekable and target_frame - current_frame > SEEK_MIN_GAP:
+                video, current_frame, seekable = _seek(video, video_path, target_frame)
+
+            # grab() only demuxes and decodes, the expensive retrieve() is left for sampled frames
+            if not video.grab():
+                break
+            stats['frames_read'] += 1
+
+            if current_frame == target_frame:
+                ret, frame = video.retrieve()
+                if not ret:
+                    break
+                timestamp = current_frame / fps if fps > 0 else video.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                yield current_frame, timestamp, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                sampled += 1
+                target_frame = int(round(sampled * step))
+
+            current_frame += 1
+    finally:
+        video.release()
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        # The file may be renamed once it is complete
+        return 0
+
+def _wait_for_growth(follow, size, stats):
+    started = time.perf_counter()
+    last_size, last_growth = size, started
+    while True:
+        time.sleep(FOLLOW_POLL_SECONDS)
+        path, complete = follow()
+        current_size = _file_size(path)
+        now = time.perf_counter()
+        if complete or current_size - size >= FOLLOW_MIN_GROWTH:
             break
+        if current_size != last_size:
+            last_size, last_growth = current_size, now
+        elif now - last_growth > FOLLOW_STALL_SECONDS:
+            raise TimeoutError(f"{path} did not grow for {FOLLOW_STALL_SECONDS:.0f}s")
+    # Waiting for the upload is not decoding
+    waited = time.perf_counter() - started
+    stats['upload_wait_seconds'] = stats.get('upload_wait_seconds', 0.0) + waited
+    stats['decode_seconds'] -= waited
 
-        if current_frame % interval == 0:
-            frame_path = os.path.join(output_folder, f"frame_{extracted_frame:04d}.jpg")
-            cv2.imwrite(frame_path, frame)
-            extracted_frame += 1
+def _iter_growing_frames(follow, frame_rate, mode, stats):
+    # Decode what has been received so far, then resume from the first sample not yet yielded
+    # once the file grew. The last frame decoded from an incomplete file may be cut short, so it
+    # is held back and decoded again on the next pass
+    sampled = 0
+    while True:
+        path, complete = follow()
+        size = _file_size(path)
+        pending = None
+        for item in _iter_capture_frames(path, frame_rate, mode, stats, (sampled, None)):
+            if pending is not None:
+                yield pending
+                sampled += 1
+            pending = item
+        if complete:
+            if pending is not None:
+                yield pending
+            return
+        _wait_for_growth(follow, size, stats)
 
-        current_frame += 1
+def _iter_keyframes(video_path, frame_rate, stats):
+    try:
+        import av
+    except ImportError:
+        raise ImportError("Keyframe sampling requires PyAV, install it with 'pip install av'.")
 
-    video.release()
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        # Let the decoder drop every frame that is not a keyframe
+        stream.codec_context.skip_frame = 'NONKEY'
+        fps = float(stream.average_rate) if stream.average_rate else 0.0
+        stats['fps'] = fps
+
+        next_time = 0.0
+        for frame in container.decode(stream):
+            stats['frames_read'] += 1
+            if frame.time is None or frame.time + 1e-6 < next_time:
+                continue
+            frame_index = int(round(frame.time * fps))
+            yield frame_index, frame.time, frame.to_ndarray(format='rgb24')
+            next_time = frame.time + 1.0 / frame_rate
+
+def sampling_step(fps, frame_rate):
+    """
+    Number of source frames between two samples, sample k is frame round(k * step).
+    """
+    return max(fps / frame_rate, 1.0) if fps > 0 else 1.0
+
+def iter_frames(video_path, frame_rate=1, mode='grab', stats=None, sample_range=None, follow=None):
+    """
+    Decode a video and yield sampled frames without writing anything to disk.
+
+    :param video_path: Path to the video file.
+    :param frame_rate: Number of frames to sample per second of video, may be fractional.
+    :param mode: 'grab' skips unused frames with grab() and only converts sampled ones,
+                 'seek' additionally seeks over long gaps, 'keyframe' only decodes keyframes
+                 (fastest, needs PyAV) and samples at most frame_rate of them per second.
+    :param stats: Optional dictionary filled with decode statistics (frames read and sampled,
+                  decode time and frames/sec).
+    :param sample_range: Optional (first, last) pair restricting decoding to samples first
+                         (inclusive) to last (exclusive, None for the end of the video), used to
+                         split a video into chunks. Not supported in 'keyframe' mode.
+    :param follow: Optional callable returning the (path, complete) pair of a video that is still
+                   being written, used instead of video_path. Decoding keeps up with the part
+                   written so far and ends once the file is complete. Not supported in 'keyframe'
+                   mode nor with sample_range.
+    :return: Generator of (frame_index, timestamp, frame) tuples, where frame_index is the
+             position of the frame in the source video, timestamp is in seconds and frame
+             is an RGB numpy array.
+    """
+    if frame_rate <= 0:
+        raise ValueError(f"frame_rate must be positive, got {frame_rate}")
+    if mode not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode '{mode}', expected one of {SAMPLING_MODES}")
+
+    if stats is None:
+        stats = {}
+    stats.update(mode=mode, frame_rate=frame_rate, frames_read=0, frames_sampled=0, decode_seconds=0.0)
+
+    if follow is not None:
+        if mode == 'keyframe' or sample_range is not None:
+            raise ValueError("Following a growing video is not supported in 'keyframe' mode nor with sample_range")
+        source = _iter_growing_frames(follow, frame_rate, mode, stats)
+    elif mode == 'keyframe':
+        if sample_range is not None:
+            raise ValueError("sample_range is not supported in 'keyframe' mode")
+        source = _iter_keyframes(video_path, frame_rate, stats)
+    else:
+        source = _iter_capture_frames(video_path, frame_rate, mode, stats, sample_range)
+
+    # Only the time spent inside the decoder is counted, not the time the consumer holds a frame
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(source)
+            except StopIteration:
+                break
+            finally:
+                stats['decode_seconds'] += time.perf_counter() - started
+            stats['frames_sampled'] += 1
+            yield item
+    finally:
+        source.close()
+        decode_seconds = stats['decode_seconds']
+        stats['decode_fps'] = stats['frames_read'] / decode_seconds if decode_seconds else 0.0
+        stats['sampled_fps'] = stats['frames_sampled'] / decode_seconds if decode_seconds else 0.0
+
+def save_frame(frame, output_folder, frame_index):
+    """
+    Write a single decoded RGB frame as a JPEG.
+
+    :param frame: RGB numpy array as yielded by iter_frames.
+    :param output_folder: Directory to write the image into.
+    :param frame_index: Index used to name the file.
+    :return: Filename of the written image, relative to output_folder.
+    """
+    import cv2
+
+    os.makedirs(output_folder, exist_ok=True)
+    frame_file = f"frame_{frame_index:06d}.jpg"
+    cv2.imwrite(os.path.join(output_folder, frame_file), cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    return frame_file
+
+def extract_frames(video_path, output_folder, frame_rate=1):
+    import cv2
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    extracted_frame = 0
+    for _, _, frame in iter_frames(video_path, frame_rate):
+        frame_path = os.path.join(output_folder, f"frame_{extracted_frame:04d}.jpg")
+        cv2.imwrite(frame_path, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        extracted_frame += 1
+    return extracted_frame
 
 # Define the class-to-index mapping
 class_to_index = {
@@ -88,62 +273,123 @@ class_to_index = {
 # Reverse the dictionary to map indexes to class names
 index_to_class = {index: cls for cls, index in class_to_index.items()}
 
-def predict_frame(model, frame_path, transform):
-    image = Image.open(frame_path).convert('RGB')
-    image = transform(image).unsqueeze(0)  # Add batch dimension
-    with torch.no_grad():
-        output = model(image)
-        _, predicted_index = torch.max(output, 1)
-    
-    predicted_index_value = predicted_index.item()
+def load_image(frame):
+    """
+    Turn a frame into a PIL image ready for the transform.
+
+    :param frame: Path to an image file, an RGB numpy array or a PIL image.
+    :return: RGB PIL image.
+    """
+    from PIL import Image
+
+    if isinstance(frame, str):
+        return Image.open(frame).convert('RGB')
+    if isinstance(frame, Image.Image):
+        return frame.convert('RGB')
+    return Image.fromarray(frame)
+
+def label_for_index(predicted_index_value):
     # Check if predicted index is in index_to_class
     if predicted_index_value in index_to_class:
-        predicted_class = index_to_class[predicted_index_value]
-    else:
-        print(f"Warning: Index {predicted_index_value} not found in index_to_class.")
-        predicted_class = 'Unknown'
-    
-    return predicted_class
+        return index_to_class[predicted_index_value]
+    print(f"Warning: Index {predicted_index_value} not found in index_to_class.")
+    return 'Unknown'
+
+def batched(iterable, batch_size):
+    """
+    Split an iterable into lists of at most batch_size items.
+
+    :param iterable: Any iterable, e.g. the generator returned by iter_frames.
+    :param batch_size: Maximum number of items per batch.
+    :return: Generator of lists.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def preprocess_frames(frames, transform):
+    """
+    Turn a list of frames into a single input batch.
+
+    :param frames: List of frames accepted by load_image.
+    :param transform: Transform turning a PIL image into a tensor.
+    :return: Tensor of shape (len(frames), 3, height, width).
+    """
+    import torch
+
+    return torch.stack([transform(load_image(frame)) for frame in frames])
+
+def run_model(model, images):
+    """
+    Run a single forward pass over a preprocessed batch, without tracking gradients.
+    """
+    import torch
+
+    with torch.no_grad():
+        return model(images)
+
+def predict_logits(model, frames, transform):
+    """
+    Run a single forward pass over a batch of frames.
+
+    :param model: The model to run, in evaluation mode.
+    :param frames: List of frames accepted by load_image.
+    :param transform: Transform turning a PIL image into a tensor.
+    :return: Tensor of shape (len(frames), num_classes) with the raw model outputs.
+    """
+    return run_model(model, preprocess_frames(frames, transform))
+
+def decode_logits(output, topk=1):
+    """
+    Turn raw model outputs into predicted class indices and top-k probabilities.
+
+    :return: Tuple (indices, top_probabilities) as returned by predict_frames.
+    """
+    import torch
+
+    _, predicted_index = torch.max(output, 1)
+    probabilities, classes = torch.softmax(output, dim=1).topk(topk, dim=1)
+
+    top_probabilities = [list(zip(frame_classes, frame_probabilities))
+                         for frame_classes, frame_probabilities in zip(classes.tolist(), probabilities.tolist())]
+    return predicted_index.tolist(), top_probabilities
+
+def predict_frames(model, frames, transform, topk=1):
+    """
+    Predict the labels of a batch of frames with a single forward pass.
+
+    :param model: The model to run, in evaluation mode.
+    :param frames: List of frames accepted by load_image.
+    :param transform: Transform turning a PIL image into a tensor.
+    :param topk: Number of most likely classes to return probabilities for.
+    :return: Tuple (indices, top_probabilities) where indices is a list with the predicted
+             class index of each frame and top_probabilities holds, for each frame, a list
+             of (class index, probability) pairs sorted by decreasing probability.
+    """
+    if not frames:
+        return [], []
+
+    return decode_logits(predict_logits(model, frames, transform), topk)
+
+def predict_frame(model, frame, transform):
+    indices, _ = predict_frames(model, [frame], transform)
+    return label_for_index(indices[0])
 
 def group_consecutive_frames(predictions, fps):
     """
     Group consecutive frames with the same predicted label and calculate the time range.
+
+    :param predictions: Dictionary where keys are frame indices and values are labels.
+    :return: List of dictionaries with label, start_time, end_time, start_frame and end_frame.
     """
-    if not predictions:
-        return []
-
-    grouped_results = []
-    current_label = None
-    start_frame = None
-
-    for frame_index, predicted_label in sorted(predictions.items()):
-        if predicted_label != current_label:
-            if current_label is not None:
-                # End of a group, calculate the time range
-                end_frame = frame_index - 1
-                start_time = start_frame / fps
-                end_time = end_frame / fps
-                grouped_results.append({
-                    'label': current_label,
-                    'start_time': start_time,
-                    'end_time': end_time
-                })
-            # Start a new group
-            current_label = predicted_label
-            start_frame = frame_index
-
-    # Add the last group
-    if current_label is not None:
-        end_frame = frame_index
-        start_time = start_frame / fps
-        end_time = end_frame / fps
-        grouped_results.append({
-            'label': current_label,
-            'start_time': start_time,
-            'end_time': end_time
-        })
-
-    return grouped_results
+    # aggregate imports the label tables from this module
+    from aggregate import group_predictions
+    return group_predictions(predictions, fps)
 
 def count_label_occurrences(predictions):
     """
@@ -189,11 +435,14 @@ def display_images_from_frames(sample_images_mapped, frames_dir):
     :param sample_images_mapped: Dictionary where keys are labels and values are frame filenames.
     :param frames_dir: Directory where frames are stored.
     """
+    import matplotlib.pyplot as plt
+    from PIL import Image
+
     for label, frame_file in sample_images_mapped.items():
         frame_path = os.path.join(frames_dir, frame_file)
         image = Image.open(frame_path)
         # Fetch the description for the label
-        description = class_description.get(label, "No description available for this label.")
+        description = description_index().get(label)
 
         # Display image with its label
         plt.figure()
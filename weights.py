@@ -0,0 +1,101 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Location of the trained CombinedModel weights
+WEIGHTS_URL = 'https://drive.google.com/uc?id=1pmZf86M8ixCAvNXanKnNTjumQGSjC8NO'
+
+# Content-addressed cache, blobs are stored as blobs/<sha256>.pth and refs/<url hash> names the blob
+WEIGHTS_CACHE_DIR = os.environ.get(
+    'WEIGHTS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'krish-video-summary'))
+
+# Expected digest of the weights, when set any other file is rejected
+WEIGHTS_SHA256 = os.environ.get('WEIGHTS_SHA256')
+
+# Weights file shipped next to the code by earlier versions, imported into the cache if present
+LEGACY_WEIGHTS_PATH = 'combined5.pth'
+
+def file_sha256(path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 hex digest of a file without loading it in memory.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _blob_path(digest, cache_dir):
+    return os.path.join(cache_dir, 'blobs', f'{digest}.pth')
+
+def _ref_path(url, cache_dir):
+    return os.path.join(cache_dir, 'refs', hashlib.sha256(url.encode()).hexdigest())
+
+def weights_digest(url=WEIGHTS_URL, cache_dir=WEIGHTS_CACHE_DIR):
+    """
+    Digest of the cached weights for a URL, read from the cache index without hashing the file.
+
+    :return: Hex digest, or None if the weights were never fetched.
+    """
+    if WEIGHTS_SHA256:
+        return WEIGHTS_SHA256
+    try:
+        with open(_ref_path(url, cache_dir)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _store(source_path, url, cache_dir, expected_sha256, move):
+    digest = file_sha256(source_path)
+    if expected_sha256 and digest != expected_sha256:
+        raise ValueError(f"Checksum mismatch for {source_path}: expected {expected_sha256}, got {digest}")
+
+    blob_path = _blob_path(digest, cache_dir)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if not os.path.exists(blob_path):
+        if move:
+            os.replace(source_path, blob_path)
+        else:
+            shutil.copyfile(source_path, blob_path)
+
+    ref_path = _ref_path(url, cache_dir)
+    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+    with open(ref_path, 'w') as f:
+        f.write(digest)
+    return blob_path, digest
+
+def fetch_weights(url=WEIGHTS_URL, expected_sha256=WEIGHTS_SHA256, cache_dir=WEIGHTS_CACHE_DIR):
+    """
+    Return a verified local copy of the model weights, downloading them only on a cache miss.
+
+    :param url: Where to download the weights from.
+    :param expected_sha256: Optional digest the weights must match.
+    :param cache_dir: Root of the weight cache.
+    :return: Tuple (path, digest) of the cached weights file.
+    """
+    digest = expected_sha256 or weights_digest(url, cache_dir)
+    if digest:
+        blob_path = _blob_path(digest, cache_dir)
+        if os.path.exists(blob_path):
+            if file_sha256(blob_path) == digest:
+                return blob_path, digest
+            print(f"Warning: Cached weights {blob_path} are corrupted, fetching them again.")
+            os.remove(blob_path)
+
+    if os.path.exists(LEGACY_WEIGHTS_PATH):
+        print(f"Importing {LEGACY_WEIGHTS_PATH} into the weight cache...")
+        return _store(LEGACY_WEIGHTS_PATH, url, cache_dir, expected_sha256, move=False)
+
+    # Only reached on a cache miss, keep the network dependency out of the import path
+    import gdown
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, download_path = tempfile.mkstemp(dir=cache_dir, suffix='.part')
+    os.close(fd)
+    try:
+        gdown.download(url, download_path, quiet=False)
+        return _store(download_path, url, cache_dir, expected_sha256, move=True)
+    finally:
+        if os.path.exists(download_path):
+            os.remove(download_path)
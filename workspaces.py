@@ -0,0 +1,68 @@
+import os
+import shutil
+import time
+
+# How long a job's workspace is kept, and how many workspaces are kept at most
+WORKSPACE_RETENTION_SECONDS = int(os.environ.get('WORKSPACE_RETENTION_SECONDS', 24 * 60 * 60))
+WORKSPACE_MAX_JOBS = int(os.environ.get('WORKSPACE_MAX_JOBS', 500))
+
+def workspace_path(root, job_id):
+    """
+    :return: Path of the workspace of a job, which may not exist.
+    :raises ValueError: If job_id could point outside of root.
+    """
+    if not job_id or os.sep in job_id or job_id.startswith('.'):
+        raise ValueError(f"Invalid job id '{job_id}'")
+    return os.path.join(root, job_id)
+
+def create_workspace(root, job_id):
+    """
+    Create the private directory a job writes its frames into.
+
+    :param root: Directory holding every workspace, e.g. static/frames/.
+    :param job_id: Identifier of the job, used as the directory name.
+    :return: Path of the workspace.
+    """
+    path = workspace_path(root, job_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def cleanup_workspaces(root, max_age=WORKSPACE_RETENTION_SECONDS, max_jobs=WORKSPACE_MAX_JOBS, keep=()):
+    """
+    Remove workspaces older than max_age seconds, then the oldest ones beyond max_jobs.
+
+    Files left directly in root by older versions are removed too.
+
+    :param keep: Job ids that must not be removed, such as the job currently running.
+    :return: Number of entries removed.
+    """
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+
+    now = time.time()
+    entries = []
+    for name in names:
+        if name in keep:
+            continue
+        path = os.path.join(root, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            pass
+    entries.sort(reverse=True)
+
+    removed = 0
+    for position, (modified, path) in enumerate(entries):
+        if now - modified <= max_age and position + len(keep) < max_jobs and os.path.isdir(path):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        removed += 1
+    return removed